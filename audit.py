@@ -0,0 +1,155 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from catalog import IMAGE_EXTENSIONS
+from pts import read_pts
+
+AUDIT_VERSION = 1
+
+
+def _file_identity(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _tail_ok(image_path, image_format):
+    # a truncated file loses its end marker; checking it costs one small read instead of a decode
+    with open(image_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 1024))
+        tail = f.read()
+    if image_format == 'PNG':
+        return b'IEND' in tail[-16:]
+    if image_format == 'JPEG':
+        return b'\xff\xd9' in tail
+    return True
+
+
+def audit_pair(image_path, label_path, expected_points=68):
+    result = {'image': image_path, 'label': label_path, 'width': None, 'height': None,
+              'points': None, 'out_of_bounds': 0, 'issues': [], 'score': 0.0}
+    issues = result['issues']
+
+    if image_path is None:
+        issues.append('missing image')
+    else:
+        try:
+            # Image.open only parses the header, pixels are never decoded here
+            with Image.open(image_path) as img:
+                result['width'], result['height'] = img.size
+                if not _tail_ok(image_path, img.format):
+                    issues.append('truncated image')
+        except Exception as e:
+            issues.append(f'unreadable image: {type(e).__name__}: {e}')
+
+    if label_path is None:
+        issues.append('missing label')
+    else:
+        try:
+            landmarks = read_pts(label_path)
+        except Exception as e:
+            issues.append(f'unreadable label: {type(e).__name__}: {e}')
+            landmarks = None
+        if landmarks is not None:
+            result['points'] = len(landmarks)
+            if expected_points is not None and len(landmarks) != expected_points:
+                issues.append(f'expected {expected_points} points, found {len(landmarks)}')
+            if np.isnan(landmarks).any():
+                issues.append('NaN coordinates')
+            if result['width'] is not None:
+                inside = ((landmarks[:, 0] >= 0) & (landmarks[:, 0] < result['width']) &
+                          (landmarks[:, 1] >= 0) & (landmarks[:, 1] < result['height']))
+                result['out_of_bounds'] = int(len(landmarks) - inside.sum())
+                if result['out_of_bounds']:
+                    issues.append(f"{result['out_of_bounds']} points outside the image")
+
+    # hard failures dominate, otherwise rank by how many points are off the image
+    hard = sum(1 for x in issues if 'points outside' not in x)
+    result['score'] = 100.0 * hard + result['out_of_bounds']
+    return result
+
+
+def _audit_job(job):
+    return audit_pair(*job)
+
+
+def _folder_pairs(folder):
+    images = {}
+    labels = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() == '.pts':
+                labels[stem] = entry.path
+            elif ext.lower() in IMAGE_EXTENSIONS:
+                images[stem] = entry.path
+    return [(images.get(stem), labels.get(stem)) for stem in sorted(set(images) | set(labels))]
+
+
+def _label_folders(data_dir):
+    folders = []
+    for dirpath, _, filenames in os.walk(data_dir):
+        if any(x.endswith('.pts') for x in filenames):
+            folders.append(dirpath)
+    return sorted(folders)
+
+
+def audit_dataset(data_dir, folders=None, workers=8, expected_points=68, report_path=None, cache_path=None):
+    # folders are relative to data_dir, by default every directory holding .pts files
+    if folders is None:
+        folders = _label_folders(data_dir)
+    else:
+        folders = [os.path.join(data_dir, x) for x in folders]
+    if cache_path is None:
+        cache_path = os.path.join(data_dir, 'audit_cache.json')
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('version') == AUDIT_VERSION and cached.get('expected_points') == expected_points:
+            cache = cached['entries']
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pairs = [pair for folder_pairs in executor.map(_folder_pairs, folders) for pair in folder_pairs]
+
+    # only pairs whose image or label changed since the last audit are checked again
+    results = [None] * len(pairs)
+    identities = []
+    todo = []
+    for i, (image_path, label_path) in enumerate(pairs):
+        identity = [_file_identity(x) if x else None for x in (image_path, label_path)]
+        identities.append(identity)
+        entry = cache.get(image_path or label_path)
+        if entry is not None and entry['identity'] == identity:
+            results[i] = entry['result']
+        else:
+            todo.append(i)
+
+    jobs = [(pairs[i][0], pairs[i][1], expected_points) for i in todo]
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            audited = list(executor.map(_audit_job, jobs, chunksize=max(1, min(256, len(jobs) // (workers * 4)))))
+    else:
+        audited = [_audit_job(job) for job in jobs]
+    for i, result in zip(todo, audited):
+        results[i] = result
+
+    entries = {}
+    for (image_path, label_path), identity, result in zip(pairs, identities, results):
+        entries[image_path or label_path] = {'identity': identity, 'result': result}
+    with open(cache_path + '.tmp', 'w') as f:
+        json.dump({'version': AUDIT_VERSION, 'expected_points': expected_points, 'entries': entries}, f)
+    os.replace(cache_path + '.tmp', cache_path)
+
+    report = {'data_dir': data_dir, 'total': len(results), 'audited': len(todo),
+              'failed': sum(1 for x in results if x['issues']), 'results': results}
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Audited {report['audited']} of {report['total']} pairs, {report['failed']} with issues")
+    return report
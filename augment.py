@@ -0,0 +1,72 @@
+import cv2
+import numpy as np
+
+from landmark_schemes import flip_permutation
+
+
+def random_params(n, rng, flip_prob=0.5, max_rotation=15.0, scale_range=(0.9, 1.1), max_translation=0.05,
+                  blur_prob=0.2, blur_sigma=(0.5, 1.5)):
+    return {
+        'flip': rng.random(n) < flip_prob,
+        'angle': rng.uniform(-max_rotation, max_rotation, n),
+        'scale': rng.uniform(scale_range[0], scale_range[1], n),
+        'translation': rng.uniform(-max_translation, max_translation, (n, 2)),
+        'blur': np.where(rng.random(n) < blur_prob, rng.uniform(blur_sigma[0], blur_sigma[1], n), 0.0),
+    }
+
+
+def affine_matrices(params, width, height):
+    # (N, 2, 3) matrices in continuous pixel coordinates (pixel j spans [j, j + 1)):
+    # flip about the vertical centre line, then rotate/scale about the centre, then shift
+    n = len(params['angle'])
+    theta = np.deg2rad(params['angle'])
+    cos = np.cos(theta) * params['scale']
+    sin = np.sin(theta) * params['scale']
+    flip = np.where(params['flip'], -1.0, 1.0)
+    cx, cy = width / 2.0, height / 2.0
+
+    matrices = np.empty((n, 2, 3))
+    matrices[:, 0, 0] = cos * flip
+    matrices[:, 0, 1] = sin
+    matrices[:, 1, 0] = -sin * flip
+    matrices[:, 1, 1] = cos
+    matrices[:, 0, 2] = cx + params['translation'][:, 0] * width - (matrices[:, 0, 0] * cx + matrices[:, 0, 1] * cy)
+    matrices[:, 1, 2] = cy + params['translation'][:, 1] * height - (matrices[:, 1, 0] * cx + matrices[:, 1, 1] * cy)
+    return matrices
+
+
+def augment_batch(images, landmarks, rng=None, params=None, normalized=True, permutation=None, **kwargs):
+    # images: (N, H, W, C) uint8, landmarks: (N, K, 2), normalized to [0, 1] as in train.txt
+    # unless normalized=False. One warpAffine per image, one batched product for all landmarks.
+    images = np.asarray(images)
+    landmarks = np.asarray(landmarks)
+    # points come back in the input precision (float32 from LandmarkDataset), computed in float64
+    dtype = landmarks.dtype if np.issubdtype(landmarks.dtype, np.floating) else np.float64
+    landmarks = landmarks.astype(np.float64)
+    n, height, width = images.shape[:3]
+    if params is None:
+        params = random_params(n, np.random.default_rng() if rng is None else rng, **kwargs)
+    matrices = affine_matrices(params, width, height)
+
+    size = np.array([width, height], dtype=np.float64)
+    points = landmarks * size if normalized else landmarks
+    points = np.einsum('nij,nkj->nki', matrices[:, :, :2], points) + matrices[:, None, :, 2]
+
+    # flipped faces swap left and right, so their landmarks are re-ordered
+    if params['flip'].any():
+        if permutation is None:
+            permutation = flip_permutation()
+        points[params['flip']] = points[params['flip']][:, permutation]
+    if normalized:
+        points /= size
+
+    # cv2 works on pixel indices (pixel centres at integers): shift by half a pixel either side
+    warp = matrices.copy()
+    warp[:, :, 2] += (matrices[:, :, 0] + matrices[:, :, 1] - 1) * 0.5
+    output = np.empty_like(images)
+    for i in range(n):
+        output[i] = cv2.warpAffine(images[i], warp[i], (width, height), flags=cv2.INTER_LINEAR,
+                                   borderMode=cv2.BORDER_CONSTANT).reshape(images.shape[1:])
+        if params['blur'][i] > 0:
+            output[i] = cv2.GaussianBlur(output[i], (0, 0), params['blur'][i]).reshape(images.shape[1:])
+    return output, points.astype(dtype)
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+import instrument
+import synthetic_data
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# End-to-end benchmarks of the converters on synthetic data:
+#
+#     python benchmark.py --samples 200 --workers 4 --report bench.json --baseline last.json
+#
+# Every case gets freshly generated input (the same for the same seed) and runs in a new process,
+# so peak RSS belongs to that case alone; pool workers started by a case are reported separately.
+
+
+def _tree_bytes(path, extensions=None):
+    return sum(os.path.getsize(os.path.join(dirpath, x)) for dirpath, _, files in os.walk(path) for x in files
+               if extensions is None or x.lower().endswith(extensions))
+
+
+def _setup_convert(case_dir, samples, seed):
+    pairs = synthetic_data.write_convert_dataset(case_dir, samples, seed=seed)
+    return pairs, _tree_bytes(case_dir)
+
+
+def _run_convert(case_dir, workers):
+    from preprocess import convert
+    convert(case_dir, workers=workers)
+
+
+def _setup_json2pts(case_dir, samples, seed):
+    # the images are written alongside, as in the vendor export, but never read
+    pairs = synthetic_data.write_keypoints_json(os.path.join(case_dir, 'json'), samples, seed=seed)
+    return pairs, _tree_bytes(os.path.join(case_dir, 'json'), ('.json',))
+
+
+def _run_json2pts(case_dir, workers):
+    from json2pts import json2pts
+    json2pts(os.path.join(case_dir, 'json'), os.path.join(case_dir, 'pts'), workers=workers)
+
+
+def _setup_face68_xml(case_dir, samples, seed):
+    pairs = synthetic_data.write_face68_xml(os.path.join(case_dir, 'xml'), samples, seed=seed)
+    return pairs, _tree_bytes(os.path.join(case_dir, 'xml'), ('.xml',))
+
+
+def _run_face68_xml(case_dir, workers):
+    from vaucher_data import batch_convert_xml_to_pts_robust
+    batch_convert_xml_to_pts_robust(os.path.join(case_dir, 'xml'), os.path.join(case_dir, 'pts'), workers=workers)
+
+
+def _setup_cvat_xml(case_dir, samples, seed):
+    xml_path = os.path.join(case_dir, 'face_annotations.xml')
+    pairs = synthetic_data.write_cvat_xml(xml_path, samples, seed=seed, image_dir=os.path.join(case_dir, 'images'))
+    return pairs, os.path.getsize(xml_path)
+
+
+def _run_cvat_xml(case_dir, workers):
+    from landmark_schemes import index_ranges
+    from zerone import stream_xml_to_pts
+    stream_xml_to_pts(os.path.join(case_dir, 'face_annotations.xml'), os.path.join(case_dir, 'pts'), index_ranges,
+                      os.path.join(case_dir, 'xml'))
+
+
+def _setup_get_sub_imgs(case_dir, samples, seed):
+    # get_sub_imgs only collects from subfolders, so spread the pairs over a few of them
+    pairs = synthetic_data.write_convert_dataset(os.path.join(case_dir, 'raw'), max(1, samples // 10), seed=seed,
+                                                 image_formats=('png',))
+    return pairs, _tree_bytes(os.path.join(case_dir, 'raw'))
+
+
+def _run_get_sub_imgs(case_dir, workers):
+    from util import get_sub_imgs
+    get_sub_imgs(os.path.join(case_dir, 'raw'), os.path.join(case_dir, 'raw', 'collected'), workers=workers)
+
+
+def _setup_split_dataset(case_dir, samples, seed):
+    pairs = synthetic_data.write_pts_folder(os.path.join(case_dir, 'main'), samples, np.random.default_rng(seed),
+                                            image_formats=('png',))
+    return pairs, _tree_bytes(os.path.join(case_dir, 'main'))
+
+
+def _run_split_dataset(case_dir, workers):
+    from util import split_dataset
+    split_dataset(os.path.join(case_dir, 'main'), os.path.join(case_dir, 'train'), os.path.join(case_dir, 'test'),
+                  mode='copy')
+
+
+def _setup_convert_png(case_dir, samples, seed):
+    # only the JPEGs are converted, the labels next to them are left alone
+    pairs = synthetic_data.write_pts_folder(os.path.join(case_dir, 'images'), samples, np.random.default_rng(seed),
+                                            image_formats=('jpg',))
+    return pairs, _tree_bytes(os.path.join(case_dir, 'images'), ('.jpg',))
+
+
+def _run_convert_png(case_dir, workers):
+    from util import convert_PNG
+    convert_PNG(os.path.join(case_dir, 'images'), workers=workers)
+
+
+# name: (setup(case_dir, samples, seed) -> (pairs written, bytes the case reads), run(case_dir, workers))
+CASES = {
+    'convert': (_setup_convert, _run_convert),
+    'json2pts': (_setup_json2pts, _run_json2pts),
+    'face68_xml': (_setup_face68_xml, _run_face68_xml),
+    'cvat_xml': (_setup_cvat_xml, _run_cvat_xml),
+    'get_sub_imgs': (_setup_get_sub_imgs, _run_get_sub_imgs),
+    'split_dataset': (_setup_split_dataset, _run_split_dataset),
+    'convert_png': (_setup_convert_png, _run_convert_png),
+}
+
+
+def _peak_rss(who):
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _mb(size):
+    return size / 2 ** 20 if size is not None else None
+
+
+def _run_case(name, case_dir, workers):
+    # runs in a fresh process, see run_benchmarks
+    run = CASES[name][1]
+    with instrument.profiling() as profiler:
+        start = time.perf_counter()
+        run(case_dir, workers)
+        elapsed = time.perf_counter() - start
+    return {'elapsed_s': elapsed, 'peak_rss': _peak_rss(resource.RUSAGE_SELF) if resource else None,
+            'peak_rss_workers': _peak_rss(resource.RUSAGE_CHILDREN) if resource else None,
+            'stages': profiler.summary()}
+
+
+def run_benchmarks(work_dir=None, samples=100, workers=1, cases=None, seed=0, repeats=1, report_path=None,
+                   baseline_path=None, tolerance=0.1, keep=False):
+    cases = list(cases or CASES)
+    unknown = [x for x in cases if x not in CASES]
+    if unknown:
+        raise ValueError(f'Unknown benchmark cases: {unknown}')
+    owned = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='landmark_bench_')
+
+    report = {'samples': samples, 'workers': workers, 'seed': seed, 'repeats': repeats, 'cases': {}}
+    try:
+        for name in cases:
+            setup = CASES[name][0]
+            best = None
+            for _ in range(repeats):
+                # inputs are regenerated each time, several cases move or delete them
+                case_dir = os.path.join(work_dir, name)
+                shutil.rmtree(case_dir, ignore_errors=True)
+                pairs, size = setup(case_dir, samples, seed)
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                    result = executor.submit(_run_case, name, case_dir, workers).result()
+                if best is None or result['elapsed_s'] < best['elapsed_s']:
+                    best = result
+            elapsed = best['elapsed_s']
+            report['cases'][name] = {
+                'files': pairs, 'bytes': size, 'elapsed_s': elapsed,
+                'files_per_s': pairs / elapsed, 'mb_per_s': size / elapsed / 2 ** 20,
+                'peak_rss_mb': _mb(best['peak_rss']), 'peak_rss_workers_mb': _mb(best['peak_rss_workers']),
+                'stages': best['stages']['stages'], 'counters': best['stages']['counters']}
+            if not keep:
+                shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+    finally:
+        if owned and not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if baseline_path is not None:
+        report['regressions'] = compare(report, baseline_path, tolerance)
+    print_report(report)
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare(report, baseline_path, tolerance=0.1):
+    # cases whose throughput dropped by more than tolerance against a previous report
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, case in report['cases'].items():
+        before = baseline['cases'].get(name)
+        if before is None:
+            continue
+        ratio = case['files_per_s'] / before['files_per_s']
+        if ratio < 1 - tolerance:
+            regressions.append({'case': name, 'files_per_s': case['files_per_s'],
+                                'baseline_files_per_s': before['files_per_s'], 'ratio': ratio})
+    return regressions
+
+
+def print_report(report):
+    print(f"\n{'case':<14}{'files':>8}{'MB':>9}{'s':>9}{'files/s':>10}{'MB/s':>9}{'peak MB':>9}{'workers MB':>12}")
+    for name, case in report['cases'].items():
+        peak = f"{case['peak_rss_mb']:.0f}" if case['peak_rss_mb'] is not None else '-'
+        workers_peak = f"{case['peak_rss_workers_mb']:.0f}" if case['peak_rss_workers_mb'] is not None else '-'
+        print(f"{name:<14}{case['files']:>8}{case['bytes'] / 2 ** 20:>9.1f}{case['elapsed_s']:>9.2f}"
+              f"{case['files_per_s']:>10.1f}{case['mb_per_s']:>9.1f}{peak:>9}{workers_peak:>12}")
+    for regression in report.get('regressions', []):
+        print(f"REGRESSION {regression['case']}: {regression['files_per_s']:.1f} files/s, "
+              f"baseline {regression['baseline_files_per_s']:.1f} ({regression['ratio']:.0%})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the dataset converters on synthetic data')
+    parser.add_argument('--samples', type=int, default=100, help='pairs per generated folder')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cases', nargs='*', choices=sorted(CASES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=1, help='runs per case, the fastest is reported')
+    parser.add_argument('--work-dir', help='where inputs are generated, a temporary directory by default')
+    parser.add_argument('--keep', action='store_true', help='keep the generated inputs and outputs')
+    parser.add_argument('--report', help='write the report as JSON')
+    parser.add_argument('--baseline', help='earlier --report output to compare throughput against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed throughput drop before failing')
+    args = parser.parse_args()
+    result = run_benchmarks(args.work_dir, args.samples, args.workers, args.cases, args.seed, args.repeats,
+                            args.report, args.baseline, args.tolerance, args.keep)
+    sys.exit(1 if result.get('regressions') else 0)
@@ -0,0 +1,310 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from pts import read_pts
+
+# Columnar index of every image/label pair under a data directory, kept in catalog.npz:
+#
+#     catalog = update_catalog('/mnt/data/Projects/Datasets/IR/')
+#     dv2_test = catalog.select(source='dv2', split='test')
+#
+# One row per file stem and directory: the image and label names ('' when one is missing), the
+# image size, the number of landmarks and their bounding box, and both files' size and mtime.
+# Directories are keyed by their own mtime (and that of a split.txt in them), so an update only
+# lists the directories where files were added, removed or renamed, and re-reads only the files
+# whose size or mtime changed there. Pass update_catalog(..., check_files=True) to also catch
+# files rewritten in place.
+
+CATALOG_VERSION = 3
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff')
+SPLIT_NAMES = ('train', 'test', 'val')
+# preprocess.convert writes images/ and shards/ next to its annotation files, into the data directory
+# itself or into one <size>/ directory per target size; a <size>/ tree is recognized by its images/
+# next to the mean face, the statistics or the shard outputs
+OUTPUT_DIRS = ('images', 'shards')
+SIZE_DIR_MARKERS = ('indices.txt', 'landmark_stats.json', 'shards')
+
+ROW_COLUMNS = ('dir', 'image', 'label', 'split', 'width', 'height', 'points', 'bbox', 'image_identity',
+               'label_identity')
+DIR_COLUMNS = ('dirs', 'dir_parent', 'dir_signature')
+
+
+def read_split_txt(path):
+    # written by util.split_dataset(mode='manifest'): "<split>\t<image>\t<label>" per line
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            row = line.rstrip('\n').split('\t')
+            if len(row) == 3:
+                rows.append(tuple(row))
+    return rows
+
+
+def image_header(path):
+    # size as cv2.imread would return it (EXIF orientation applied), read from the header only
+    with Image.open(path) as img:
+        width, height = img.size
+        image_format = img.format
+        if image_format == 'JPEG' and img.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height, image_format
+
+
+def is_output_dir(path, top_level=False):
+    # convert output rather than source data; it only ever sits directly under the data directory
+    if not top_level:
+        return False
+    name = os.path.basename(os.path.normpath(path))
+    if name in OUTPUT_DIRS:
+        return True
+    return (name.isdigit() and os.path.isdir(os.path.join(path, 'images'))
+            and any(os.path.exists(os.path.join(path, x)) for x in SIZE_DIR_MARKERS))
+
+
+def _scan_pair(folder, image_name, label_name):
+    width = height = points = -1
+    bbox = (np.nan,) * 4
+    if image_name:
+        try:
+            width, height, _ = image_header(os.path.join(folder, image_name))
+        except Exception:
+            pass
+    if label_name:
+        try:
+            landmarks = read_pts(os.path.join(folder, label_name))
+            points = len(landmarks)
+            if points:
+                bbox = (*landmarks.min(axis=0), *landmarks.max(axis=0))
+        except Exception:
+            pass
+    return width, height, points, bbox
+
+
+def _identity(entry):
+    if entry is None:
+        return (0, 0)
+    st = entry.stat()
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _dir_signature(path):
+    try:
+        split_mtime = os.stat(os.path.join(path, 'split.txt')).st_mtime_ns
+    except FileNotFoundError:
+        split_mtime = 0
+    return (os.stat(path).st_mtime_ns, split_mtime)
+
+
+class Catalog:
+    def __init__(self, data_dir, columns):
+        self.data_dir = data_dir
+        self.columns = columns
+        self._dirs = [x.decode() for x in columns['dirs']]
+        self._dir_index = {x: i for i, x in enumerate(self._dirs)}
+
+    def __len__(self):
+        return len(self.columns['dir'])
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns')
+        if columns is None or name not in columns:
+            raise AttributeError(name)
+        column = columns[name]
+        if column.dtype.kind == 'S':
+            return np.char.decode(column, 'utf-8')
+        return column
+
+    @property
+    def sources(self):
+        # the top-level folder of every row (dv2, zerone2, ...)
+        tops = np.array([x.split('/')[0] for x in self.dirs] or [''])
+        return tops[self.columns['dir']]
+
+    def image_path(self, i):
+        return os.path.join(self.data_dir, self.dirs[self.columns['dir'][i]], self.columns['image'][i].decode())
+
+    def label_path(self, i):
+        return os.path.join(self.data_dir, self.dirs[self.columns['dir'][i]], self.columns['label'][i].decode())
+
+    def _folder_index(self, folder):
+        # given as a path, absolute or relative to the working directory
+        relative = os.path.relpath(os.path.abspath(folder), os.path.abspath(self.data_dir)).replace(os.sep, '/')
+        return self._dir_index.get('' if relative == '.' else relative)
+
+    def has_folder(self, folder):
+        # False for folders outside data_dir or left out of the catalog, callers list those themselves
+        return self._folder_index(folder) is not None
+
+    def folder_rows(self, folder):
+        index = self._folder_index(folder)
+        if index is None:
+            return np.empty(0, dtype=np.int64)
+        return np.flatnonzero(self.columns['dir'] == index)
+
+    def select(self, source=None, split=None, folder=None, paired=True):
+        mask = np.ones(len(self), dtype=bool)
+        if source is not None:
+            mask &= self.sources == source
+        if split is not None:
+            mask &= self.columns['split'] == split.encode()
+        if folder is not None:
+            mask &= np.isin(np.arange(len(self)), self.folder_rows(folder))
+        if paired:
+            mask &= (self.columns['image'] != b'') & (self.columns['label'] != b'')
+        return np.flatnonzero(mask)
+
+    def unpaired(self):
+        return np.flatnonzero((self.columns['image'] == b'') | (self.columns['label'] == b''))
+
+    @property
+    def dirs(self):
+        return self._dirs
+
+    def save(self, path=None):
+        path = path or os.path.join(self.data_dir, 'catalog.npz')
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, version=np.array(CATALOG_VERSION), **self.columns)
+        os.replace(path + '.tmp', path)
+
+
+def load_catalog(data_dir, path=None):
+    path = path or os.path.join(data_dir, 'catalog.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        if int(f['version']) != CATALOG_VERSION:
+            return None
+        columns = {name: f[name] for name in ROW_COLUMNS + DIR_COLUMNS}
+    return Catalog(data_dir, columns)
+
+
+def _empty_rows():
+    return {'image': [], 'label': [], 'split': [], 'width': [], 'height': [], 'points': [], 'bbox': [],
+            'image_identity': [], 'label_identity': []}
+
+
+def update_catalog(data_dir, workers=8, path=None, skip=(), check_files=False):
+    # skip names further top-level folders to leave out, convert output is always left out
+    old = load_catalog(data_dir, path)
+    old_dirs = {}
+    if old is not None:
+        old_dir_names = old.dirs
+        rows_of = {}
+        for row, d in enumerate(old.columns['dir'].tolist()):
+            rows_of.setdefault(d, []).append(row)
+        children_of = {}
+        for d, parent in enumerate(old.columns['dir_parent'].tolist()):
+            if parent >= 0:
+                children_of.setdefault(parent, []).append(old_dir_names[d])
+        for d, name in enumerate(old_dir_names):
+            old_dirs[name] = (tuple(old.columns['dir_signature'][d].tolist()), rows_of.get(d, []),
+                              children_of.get(d, []))
+
+    dirs = []
+    parents = []
+    signatures = []
+    # (dir index, old row to copy or None, folder, image, label, split, identities) in catalog order
+    plan = []
+    stack = [('', -1)]
+    while stack:
+        relative, parent = stack.pop()
+        folder = os.path.join(data_dir, relative)
+        try:
+            signature = _dir_signature(folder)
+        except FileNotFoundError:
+            # removed since its parent was listed
+            continue
+        index = len(dirs)
+        dirs.append(relative)
+        parents.append(parent)
+        signatures.append(signature)
+        previous = old_dirs.get(relative)
+        if previous is not None and previous[0] == signature and not check_files:
+            plan.extend((index, row, None, None, None, None, None) for row in previous[1])
+            children = previous[2]
+        else:
+            children = []
+            images = {}
+            labels = {}
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not (entry.name.startswith('.') or (relative == '' and entry.name in skip)
+                                or is_output_dir(entry.path, top_level=relative == '')):
+                            children.append(f'{relative}/{entry.name}' if relative else entry.name)
+                        continue
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext.lower() == '.pts':
+                        labels[stem] = entry
+                    elif ext.lower() in IMAGE_EXTENSIONS:
+                        images[stem] = entry
+            manifest = {}
+            if signature[1]:
+                manifest = {image: split for split, image, _ in read_split_txt(os.path.join(folder, 'split.txt'))}
+            folder_split = next((x for x in reversed(relative.split('/')) if x in SPLIT_NAMES), '')
+            reusable = {}
+            if previous is not None:
+                for row in previous[1]:
+                    reusable[(old.columns['image'][row], old.columns['label'][row])] = row
+            for stem in sorted(set(images) | set(labels)):
+                image, label = images.get(stem), labels.get(stem)
+                image_name = image.name if image is not None else ''
+                label_name = label.name if label is not None else ''
+                identities = (_identity(image), _identity(label))
+                split = manifest.get(image_name, folder_split)
+                row = reusable.get((image_name.encode(), label_name.encode()))
+                if row is not None and (tuple(old.columns['image_identity'][row].tolist()),
+                                        tuple(old.columns['label_identity'][row].tolist())) != identities:
+                    row = None
+                plan.append((index, row, folder, image_name, label_name, split, identities))
+        for child in sorted(children, reverse=True):
+            stack.append((child, index))
+
+    todo = [i for i, item in enumerate(plan) if item[1] is None]
+    jobs = [(plan[i][2], plan[i][3], plan[i][4]) for i in todo]
+    if workers > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scanned = list(executor.map(lambda job: _scan_pair(*job), jobs))
+    else:
+        scanned = [_scan_pair(*job) for job in jobs]
+    scanned = dict(zip(todo, scanned))
+
+    rows = _empty_rows()
+    for i, (index, row, folder, image_name, label_name, split, identities) in enumerate(plan):
+        if row is not None and i not in scanned:
+            for name in rows:
+                rows[name].append(old.columns[name][row])
+            if split is not None:
+                # the labels were reused, the split may have changed with split.txt
+                rows['split'][-1] = split.encode()
+            continue
+        width, height, points, bbox = scanned[i]
+        for name, value in (('image', image_name.encode()), ('label', label_name.encode()), ('split', split.encode()),
+                            ('width', width), ('height', height), ('points', points), ('bbox', bbox),
+                            ('image_identity', identities[0]), ('label_identity', identities[1])):
+            rows[name].append(value)
+
+    columns = {
+        'dir': np.array([item[0] for item in plan], dtype=np.int32),
+        'image': np.array(rows['image'], dtype=bytes),
+        'label': np.array(rows['label'], dtype=bytes),
+        'split': np.array(rows['split'], dtype=bytes),
+        'width': np.array(rows['width'], dtype=np.int32),
+        'height': np.array(rows['height'], dtype=np.int32),
+        'points': np.array(rows['points'], dtype=np.int32),
+        'bbox': np.array(rows['bbox'], dtype=np.float32).reshape(-1, 4),
+        'image_identity': np.array(rows['image_identity'], dtype=np.int64).reshape(-1, 2),
+        'label_identity': np.array(rows['label_identity'], dtype=np.int64).reshape(-1, 2),
+        'dirs': np.array([x.encode() for x in dirs], dtype=bytes),
+        'dir_parent': np.array(parents, dtype=np.int32),
+        'dir_signature': np.array(signatures, dtype=np.int64).reshape(-1, 2),
+    }
+    catalog = Catalog(data_dir, columns)
+    catalog.save(path)
+    rescanned = sum(1 for item in plan if item[2] is not None)
+    print(f"Catalog of {len(catalog)} rows in {len(dirs)} directories, {rescanned} rows listed again, "
+          f"{len(todo)} files read")
+    return catalog
@@ -0,0 +1,294 @@
+import argparse
+import sys
+
+# One entry point for the toolkit:
+#
+#     python cli.py verify images/ labels/
+#     python cli.py --profile summary.json convert /mnt/data/Projects/Datasets/IR/ --workers 8
+#
+# Every subcommand imports its module when it runs, so cheap operations never load cv2, numpy
+# or PIL. Handlers return a process exit code (None for success).
+
+
+def _catalog(path, workers=8):
+    # refreshing is incremental, so it is cheap enough to do before every command that reads it
+    if path is None:
+        return None
+    from catalog import update_catalog
+    return update_catalog(path, workers)
+
+
+def _json2pts(args):
+    from json2pts import json2pts
+    report = json2pts(args.root, args.dest, args.workers, args.report)
+    return 1 if report['errors'] else None
+
+
+def _face68_xml(args):
+    from vaucher_data import batch_convert_xml_to_pts_robust
+    report = batch_convert_xml_to_pts_robust(args.input_dir, args.output_dir, args.workers, args.report)
+    return 1 if report['errors'] else None
+
+
+def _cvat_xml(args):
+    from landmark_schemes import index_ranges
+    from zerone import convert_xml_to_pts_based_on_indexes, stream_xml_to_pts
+    if args.per_image:
+        report = convert_xml_to_pts_based_on_indexes(args.source, args.pts_dir, args.workers, args.report)
+        return 1 if report['errors'] else None
+    stream_xml_to_pts(args.source, args.pts_dir, index_ranges, args.xml_dir)
+
+
+def _check_pts(args):
+    from vaucher_data import check_pts_files
+    check_pts_files(args.directory, _catalog(args.catalog))
+
+
+def _update_catalog(args):
+    from catalog import update_catalog
+    catalog = update_catalog(args.data_dir, args.workers, check_files=args.check_files)
+    unpaired = catalog.unpaired()
+    for i in unpaired[:20].tolist():
+        print('unpaired:', catalog.image_path(i) if catalog.columns['image'][i] else catalog.label_path(i))
+    return 1 if len(unpaired) else None
+
+
+def _convert(args):
+    from preprocess import convert
+    target_size = args.target_size[0] if len(args.target_size) == 1 else args.target_size
+    convert(args.data_dir, target_size, args.workers, args.incremental, args.store, args.archive, args.shard_index,
+            args.shard_count, catalog=args.catalog or None, reduced_decode=args.reduced_decode)
+
+
+def _merge_shards(args):
+    from preprocess import merge_shards
+    target_size = args.target_size[0] if len(args.target_size) == 1 else args.target_size
+    merge_shards(args.data_dir, args.shard_count, target_size, args.store)
+
+
+def _split(args):
+    from util import split_dataset
+    split_dataset(args.main_folder, args.train_folder, args.test_folder, args.test_ratio, args.seed, args.mode,
+                  args.manifest, _catalog(args.catalog))
+
+
+def _collect(args):
+    from util import collect_files
+    collect_files(args.src1, args.src2, args.destination, args.mode)
+
+
+def _verify(args):
+    from util import verify_name_pairs
+    return None if verify_name_pairs(args.image_dir, args.label_dir, _catalog(args.catalog)) else 1
+
+
+def _sub_imgs(args):
+    from util import get_sub_imgs
+    moves = get_sub_imgs(args.path, args.target_path, args.dry_run, args.workers)
+    if args.dry_run:
+        for source, target in moves:
+            print(f'{source} -> {target}')
+
+
+def _to_png(args):
+    from util import convert_PNG
+    summary = convert_PNG(args.folder, args.workers, args.format, args.compress_level)
+    return 1 if summary['failed'] or summary['conflicts'] else None
+
+
+def _move_different(args):
+    from util import move_different_files
+    move_different_files(args.images_folder, args.labels_folder, args.different_folder)
+
+
+def _rename(args):
+    from util import rename_files
+    rename_files(args.directory)
+
+
+def _visualize(args):
+    from util import visualize_landmarks
+    visualize_landmarks(args.image, args.pts, args.output, args.show)
+
+
+def _audit(args):
+    from audit import audit_dataset
+    report = audit_dataset(args.data_dir, args.folders, args.workers, args.expected_points, args.report)
+    return 1 if report['failed'] else None
+
+
+def _sheets(args):
+    from contact_sheet import contact_sheets
+    contact_sheets(args.data_dir, args.output_dir, args.sample, args.count, args.seed, args.folders, args.workers,
+                   tile_size=args.tile_size, columns=args.columns, rows=args.rows, numbers=args.numbers)
+
+
+def _dedup(args):
+    from dedup import find_duplicates
+    report = find_duplicates(args.data_dir, args.max_distance, args.workers, report_path=args.report)
+    return 1 if report['leaking_clusters'] else None
+
+
+def _to_store(args):
+    from landmark_store import text_to_store
+    text_to_store(args.txt_path, args.prefix)
+
+
+def _unpack(args):
+    from crop_archive import unpack_archive
+    unpack_archive(args.prefix, args.output_dir)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='Facial landmark dataset preprocessing toolkit')
+    parser.add_argument('--profile', metavar='PATH', help='write a per-stage timing summary (JSON)')
+    parser.add_argument('--trace', metavar='PATH', help='write a Chrome trace of every stage')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def command(name, func, help_text):
+        sub = commands.add_parser(name, help=help_text, description=help_text)
+        sub.set_defaults(func=func)
+        return sub
+
+    sub = command('json2pts', _json2pts, 'convert vendor KeyPoints JSON labels to PTS')
+    sub.add_argument('root')
+    sub.add_argument('dest')
+    sub.add_argument('--workers', type=int, default=1)
+    sub.add_argument('--report', help='write the conversion report (JSON)')
+
+    sub = command('face68-xml', _face68_xml, 'convert per-image face_68 XML labels to PTS')
+    sub.add_argument('input_dir')
+    sub.add_argument('output_dir')
+    sub.add_argument('--workers', type=int, default=1)
+    sub.add_argument('--report')
+
+    sub = command('cvat-xml', _cvat_xml, 'relabel a CVAT face_annotations.xml export and write PTS files')
+    sub.add_argument('source', help='the CVAT export, or a folder of per-image XML files with --per-image')
+    sub.add_argument('pts_dir')
+    sub.add_argument('--xml-dir', help='also write one relabeled XML per image')
+    sub.add_argument('--per-image', action='store_true', help='source is a folder of already split XML files')
+    sub.add_argument('--workers', type=int, default=1)
+    sub.add_argument('--report')
+
+    sub = command('check-pts', _check_pts, 'list PTS files whose header does not declare 68 points')
+    sub.add_argument('directory')
+    sub.add_argument('--catalog', metavar='DATA_DIR',
+                     help='check the number of points parsed into the catalog of DATA_DIR instead of the '
+                          'n_points header (directories it does not cover are read directly)')
+
+    sub = command('catalog', _update_catalog, 'build or refresh the sample catalog (catalog.npz) of a data directory')
+    sub.add_argument('data_dir')
+    sub.add_argument('--workers', type=int, default=8)
+    sub.add_argument('--check-files', action='store_true', help='also re-stat files in unchanged directories')
+
+    for name, func, help_text in (('convert', _convert, 'crop faces and write the training annotation files'),
+                                  ('merge-shards', _merge_shards, 'merge the outputs of sharded convert runs')):
+        sub = command(name, func, help_text)
+        sub.add_argument('data_dir')
+        sub.add_argument('--target-size', type=int, nargs='+', default=[256],
+                         help='several sizes write one output tree per size')
+        sub.add_argument('--store', action='store_true', help='also write the memmap landmark store')
+        sub.add_argument('--shard-count', type=int, default=1)
+        if func is _convert:
+            sub.add_argument('--workers', type=int, default=1)
+            sub.add_argument('--incremental', action='store_true')
+            sub.add_argument('--archive', choices=['encoded', 'raw'])
+            sub.add_argument('--shard-index', type=int)
+            sub.add_argument('--catalog', action='store_true', help='list samples from data_dir/catalog.npz')
+            sub.add_argument('--reduced-decode', action='store_true',
+                             help='decode large JPEG faces at reduced scale (faster, crops differ slightly)')
+
+    sub = command('split', _split, 'split a folder of image/label pairs into train and test')
+    sub.add_argument('main_folder')
+    sub.add_argument('train_folder')
+    sub.add_argument('test_folder')
+    sub.add_argument('--test-ratio', type=float, default=0.2)
+    sub.add_argument('--seed', type=int, default=0)
+    sub.add_argument('--mode', choices=['move', 'copy', 'link', 'manifest'], default='move')
+    sub.add_argument('--manifest', help='split.txt location for --mode manifest')
+    sub.add_argument('--catalog', metavar='DATA_DIR', help='take the file list from the catalog of DATA_DIR')
+
+    sub = command('collect', _collect, 'gather the files of two folders into one')
+    sub.add_argument('src1')
+    sub.add_argument('src2')
+    sub.add_argument('destination')
+    sub.add_argument('--mode', choices=['move', 'copy', 'link'], default='copy')
+
+    sub = command('verify', _verify, 'check that every image has a label and the other way round')
+    sub.add_argument('image_dir')
+    sub.add_argument('label_dir')
+    sub.add_argument('--catalog', metavar='DATA_DIR', help='take the file lists from the catalog of DATA_DIR')
+
+    sub = command('sub-imgs', _sub_imgs, 'move images out of subfolders into one folder')
+    sub.add_argument('path')
+    sub.add_argument('target_path')
+    sub.add_argument('--dry-run', action='store_true', help='only print the planned moves')
+    sub.add_argument('--workers', type=int, default=1)
+
+    sub = command('to-png', _to_png, 'convert JPEG images in place (and delete the originals)')
+    sub.add_argument('folder')
+    sub.add_argument('--workers', type=int, default=1)
+    sub.add_argument('--format', choices=['PNG', 'WEBP', 'BMP'], default='PNG')
+    sub.add_argument('--compress-level', type=int, default=6)
+
+    sub = command('move-different', _move_different, 'move images without a label into another folder')
+    sub.add_argument('images_folder')
+    sub.add_argument('labels_folder')
+    sub.add_argument('different_folder')
+
+    sub = command('rename', _rename, 'remove spaces from file names one folder level down')
+    sub.add_argument('directory')
+
+    sub = command('visualize', _visualize, 'draw the landmarks of one image')
+    sub.add_argument('image')
+    sub.add_argument('pts')
+    sub.add_argument('--output')
+    sub.add_argument('--show', action='store_true', help='open a window and wait for a key')
+
+    sub = command('audit', _audit, 'check image/label pairs for missing, truncated or out-of-bounds data')
+    sub.add_argument('data_dir')
+    sub.add_argument('--folders', nargs='*')
+    sub.add_argument('--workers', type=int, default=8)
+    sub.add_argument('--expected-points', type=int, default=68)
+    sub.add_argument('--report')
+
+    sub = command('sheets', _sheets, 'render QA contact sheets of landmark overlays')
+    sub.add_argument('data_dir')
+    sub.add_argument('output_dir')
+    sub.add_argument('--sample', choices=['random', 'worst', 'all'], default='random')
+    sub.add_argument('--count', type=int, default=1000)
+    sub.add_argument('--seed', type=int, default=0)
+    sub.add_argument('--folders', nargs='*')
+    sub.add_argument('--workers', type=int, default=8)
+    sub.add_argument('--tile-size', type=int, default=192)
+    sub.add_argument('--columns', type=int, default=8)
+    sub.add_argument('--rows', type=int, default=6)
+    sub.add_argument('--numbers', action='store_true', help='label every point with its index')
+
+    sub = command('dedup', _dedup, 'find near-duplicate images and train/test leakage')
+    sub.add_argument('data_dir')
+    sub.add_argument('--max-distance', type=int, default=4, help='Hamming distance between perceptual hashes')
+    sub.add_argument('--workers', type=int, default=8)
+    sub.add_argument('--report')
+
+    sub = command('to-store', _to_store, 'turn a train.txt/test.txt annotation file into a landmark store')
+    sub.add_argument('txt_path')
+    sub.add_argument('--prefix')
+
+    sub = command('unpack', _unpack, 'write the crops of a crop archive out as individual files')
+    sub.add_argument('prefix')
+    sub.add_argument('output_dir')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.profile is None and args.trace is None:
+        return args.func(args)
+    import instrument
+    with instrument.profiling(args.profile, args.trace):
+        return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
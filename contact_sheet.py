@@ -0,0 +1,160 @@
+import collections
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from audit import _folder_pairs, _label_folders, audit_dataset
+from pts import read_pts
+from util import draw_landmarks
+
+# Headless landmark QA: overlays the landmarks of many image/label pairs in parallel and tiles
+# them into contact sheets (sheet_0000.jpg, ...) plus sheets.json, which maps every cell back to
+# its files. Nothing is ever shown on screen.
+#
+#     contact_sheets('/data/vendor_batch', '/data/qa', sample='worst', count=2000)
+
+REDUCED_DECODE_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8}
+CAPTION_HEIGHT = 14
+
+
+def _decode_for_tile(image_path, tile_size):
+    # decode at the largest reduction that still covers the tile; the libjpeg DCT scaling makes
+    # this several times faster than a full decode for camera-sized JPEGs
+    with Image.open(image_path) as img:
+        longest = max(img.size)
+    factor = 1
+    for f in (2, 4, 8):
+        if longest / f >= tile_size:
+            factor = f
+    image = cv2.imread(image_path, REDUCED_DECODE_FLAGS[factor] if factor > 1 else cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError(f'cv2.imread failed for {image_path}')
+    return image, factor
+
+
+def _caption(tile, text, color=(255, 255, 255)):
+    cv2.rectangle(tile, (0, 0), (tile.shape[1], CAPTION_HEIGHT), (0, 0, 0), -1)
+    cv2.putText(tile, text, (2, CAPTION_HEIGHT - 4), cv2.FONT_HERSHEY_SIMPLEX, 0.35, color, 1, cv2.LINE_AA)
+
+
+def render_tile(image_path, label_path, tile_size=192, caption=None, numbers=False):
+    # letterboxed tile_size x tile_size BGR tile; problems are drawn onto a grey tile instead of raised,
+    # a QA sheet has to show the broken pairs too
+    tile = np.full((tile_size, tile_size, 3), 64, dtype=np.uint8)
+    try:
+        if image_path is None:
+            raise FileNotFoundError('no image for this label')
+        image, factor = _decode_for_tile(image_path, tile_size)
+        landmarks = read_pts(label_path) / factor if label_path is not None else np.empty((0, 2))
+        height, width = image.shape[:2]
+        scale = tile_size / max(height, width)
+        new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+        x0, y0 = (tile_size - new_width) // 2, (tile_size - new_height) // 2
+        tile[y0:y0 + new_height, x0:x0 + new_width] = cv2.resize(image, (new_width, new_height),
+                                                                 interpolation=cv2.INTER_AREA)
+        # points are drawn after downscaling so they stay visible at any tile size
+        draw_landmarks(tile, landmarks * scale + (x0, y0), radius=1, numbers=numbers, color=(0, 255, 0))
+    except Exception as e:
+        _caption(tile, caption or '', (0, 0, 255))
+        message = f'{type(e).__name__}: {e}'
+        for i in range(0, min(len(message), 120), 24):
+            cv2.putText(tile, message[i:i + 24], (2, 2 * CAPTION_HEIGHT + i // 24 * 12), cv2.FONT_HERSHEY_SIMPLEX,
+                        0.3, (0, 0, 255), 1, cv2.LINE_AA)
+        return tile
+    if caption:
+        _caption(tile, caption)
+    return tile
+
+
+def _render_job(job):
+    return render_tile(*job)
+
+
+def _tiles(jobs, executor, window):
+    if executor is None:
+        yield from map(_render_job, jobs)
+        return
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(executor.submit(_render_job, job))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _init_worker():
+    cv2.setNumThreads(1)
+
+
+def sample_pairs(pairs, count=None, sample='random', seed=0, scores=None):
+    # sample: 'all', 'random' (seeded) or 'worst' (highest scores first, see audit.audit_pair)
+    if sample == 'all' or count is None or (sample == 'random' and count >= len(pairs)):
+        return list(pairs)
+    if sample == 'random':
+        return random.Random(seed).sample(list(pairs), count)
+    if sample == 'worst':
+        order = sorted(range(len(pairs)), key=lambda i: -scores[i])
+        return [pairs[i] for i in order[:count]]
+    raise ValueError(f'Unknown sample: {sample}')
+
+
+def render_sheets(pairs, output_dir, tile_size=192, columns=8, rows=6, workers=8, captions=None, numbers=False,
+                  quality=85, prefix='sheet'):
+    # pairs: (image_path, label_path) in sheet order; captions default to the image file name
+    os.makedirs(output_dir, exist_ok=True)
+    if captions is None:
+        captions = [os.path.basename(image or label or '') for image, label in pairs]
+    jobs = [(image, label, tile_size, caption, numbers) for (image, label), caption in zip(pairs, captions)]
+    per_sheet = columns * rows
+
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) if workers > 1 else None
+    sheets = []
+    sheet = None
+    try:
+        # tiles are rendered at most two sheets ahead, so memory stays flat however many pairs there are
+        for done, tile in enumerate(_tiles(jobs, executor, 2 * per_sheet)):
+            cell = done % per_sheet
+            if cell == 0:
+                sheet = np.zeros((rows * tile_size, columns * tile_size, 3), dtype=np.uint8)
+                sheets.append({'file': f'{prefix}_{len(sheets):04d}.jpg', 'cells': []})
+            row, column = divmod(cell, columns)
+            sheet[row * tile_size:(row + 1) * tile_size, column * tile_size:(column + 1) * tile_size] = tile
+            image, label = pairs[done]
+            sheets[-1]['cells'].append({'row': row, 'column': column, 'image': image, 'label': label})
+            if cell == per_sheet - 1 or done == len(jobs) - 1:
+                cv2.imwrite(os.path.join(output_dir, sheets[-1]['file']), sheet,
+                            [cv2.IMWRITE_JPEG_QUALITY, quality])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    with open(os.path.join(output_dir, f'{prefix}s.json'), 'w') as f:
+        json.dump({'tile_size': tile_size, 'columns': columns, 'rows': rows, 'sheets': sheets}, f, indent=2)
+    print(f"Rendered {len(jobs)} pairs into {len(sheets)} sheets in {output_dir}")
+    return sheets
+
+
+def contact_sheets(data_dir, output_dir, sample='random', count=1000, seed=0, folders=None, workers=8,
+                   audit_report=None, **kwargs):
+    # sample='worst' ranks pairs by audit score; an audit_dataset report can be passed in, otherwise
+    # one is run (it is cached in data_dir, so only new or changed pairs are checked)
+    if sample == 'worst':
+        report = audit_report or audit_dataset(data_dir, folders, workers=workers)
+        results = report['results']
+        pairs = [(x['image'], x['label']) for x in results]
+        chosen = sample_pairs(pairs, count, 'worst', scores=[x['score'] for x in results])
+        by_pair = {(x['image'], x['label']): x for x in results}
+        captions = [f"{by_pair[p]['score']:.0f} {os.path.basename(p[0] or p[1])}" for p in chosen]
+    else:
+        folders = _label_folders(data_dir) if folders is None else [os.path.join(data_dir, x) for x in folders]
+        pairs = [pair for folder in folders for pair in _folder_pairs(folder)]
+        chosen = sample_pairs(pairs, count, sample, seed)
+        captions = None
+    return render_sheets(chosen, output_dir, workers=workers, captions=captions, **kwargs)
@@ -0,0 +1,127 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+# An archive is a handful of large shard files plus an offset index, all sharing a prefix:
+#   <prefix>-00000.shard ...  concatenated samples
+#   <prefix>.index.npy        int64 (N, 3) array of shard id, byte offset, byte length
+#   <prefix>.names.txt        file name of sample i on line i
+#   <prefix>.archive.json     storage mode ('encoded' or 'raw') and raw sample shape
+# 'encoded' keeps each crop as PNG/JPEG bytes (encoded by file extension), 'raw' stores
+# uint8 target_size x target_size x 3 arrays that need no decoding at all.
+
+SHARD_SIZE = 1 << 30
+
+
+def encode_crop(name, image, mode='encoded'):
+    if mode == 'raw':
+        return np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+    ok, buffer = cv2.imencode(os.path.splitext(name)[1], image)
+    if not ok:
+        raise IOError(f'cv2.imencode failed for {name}')
+    return buffer.tobytes()
+
+
+class CropArchiveWriter:
+    def __init__(self, prefix, mode='encoded', shard_size=SHARD_SIZE, shape=None):
+        if mode not in ('encoded', 'raw'):
+            raise ValueError(f'Unknown archive mode: {mode}')
+        self.prefix = prefix
+        self.mode = mode
+        self.shard_size = shard_size
+        self.shape = list(shape) if shape else None
+        self._index = []
+        self._names = []
+        self._shard_id = -1
+        self._shard = None
+        self._offset = 0
+        self._closed = False
+
+    def _next_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_id += 1
+        self._shard = open(f'{self.prefix}-{self._shard_id:05d}.shard', 'wb')
+        self._offset = 0
+
+    def append(self, name, image):
+        if self.mode == 'raw':
+            if self.shape is None:
+                self.shape = list(image.shape)
+            elif list(image.shape) != self.shape:
+                raise ValueError(f'{name} has shape {image.shape}, expected {tuple(self.shape)}')
+        self.append_bytes(name, encode_crop(name, image, self.mode))
+
+    def append_bytes(self, name, data):
+        if self._shard is None or (self._offset and self._offset + len(data) > self.shard_size):
+            self._next_shard()
+        self._shard.write(data)
+        self._index.append((self._shard_id, self._offset, len(data)))
+        self._names.append(name)
+        self._offset += len(data)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._shard is not None:
+            self._shard.close()
+        np.save(self.prefix + '.index.npy', np.array(self._index, dtype=np.int64).reshape(-1, 3))
+        with open(self.prefix + '.names.txt', 'w') as f:
+            f.write(''.join(name + '\n' for name in self._names))
+        with open(self.prefix + '.archive.json', 'w') as f:
+            json.dump({'mode': self.mode, 'shape': self.shape, 'shards': self._shard_id + 1}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CropArchive:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + '.archive.json', 'r') as f:
+            header = json.load(f)
+        self.mode = header['mode']
+        self.shape = tuple(header['shape']) if header['shape'] else None
+        self.index = np.load(prefix + '.index.npy')
+        with open(prefix + '.names.txt', 'r') as f:
+            self.names = f.read().splitlines()
+        self._shards = [None] * header['shards']
+
+    def __len__(self):
+        return len(self.names)
+
+    def _shard(self, shard_id):
+        # shards are mapped on first use, so forked DataLoader workers map their own
+        if self._shards[shard_id] is None:
+            self._shards[shard_id] = np.memmap(f'{self.prefix}-{shard_id:05d}.shard', dtype=np.uint8, mode='r')
+        return self._shards[shard_id]
+
+    def read_bytes(self, i):
+        shard_id, offset, length = self.index[i]
+        return self._shard(shard_id)[offset:offset + length]
+
+    def __getitem__(self, i):
+        data = self.read_bytes(i)
+        if self.mode == 'raw':
+            return np.asarray(data).reshape(self.shape)
+        return cv2.imdecode(np.asarray(data), cv2.IMREAD_COLOR)
+
+
+def unpack_archive(prefix, output_dir):
+    # restores the one-file-per-crop layout convert() writes without an archive
+    archive = CropArchive(prefix)
+    os.makedirs(output_dir, exist_ok=True)
+    for i, name in enumerate(archive.names):
+        output_path = os.path.join(output_dir, name)
+        if archive.mode == 'raw':
+            cv2.imwrite(output_path, archive[i])
+        else:
+            with open(output_path, 'wb') as f:
+                f.write(archive.read_bytes(i).tobytes())
+    return len(archive)
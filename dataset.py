@@ -0,0 +1,142 @@
+import collections
+import multiprocessing
+import os
+
+import numpy
+import torch
+from torch.utils.data import Dataset
+
+from preprocess import list_samples, process
+
+
+class CropCache:
+    # LRU of decoded (crop, landmarks) pairs bounded by total bytes; one per process
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, image, landmarks):
+        size = image.nbytes + landmarks.nbytes
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            old_image, old_landmarks = self.entries.pop(key)
+            self.bytes -= old_image.nbytes + old_landmarks.nbytes
+        while self.bytes + size > self.max_bytes:
+            _, (old_image, old_landmarks) = self.entries.popitem(last=False)
+            self.bytes -= old_image.nbytes + old_landmarks.nbytes
+        self.entries[key] = (image, landmarks)
+        self.bytes += size
+
+
+class SharedCropCache:
+    # Direct-mapped cache in shared memory: created before the DataLoader starts its workers,
+    # so every worker sees crops decoded by the others. Sample i lives in slot i % slots.
+    # Writers of a slot are serialized by a lock striped over the slots, and a writer that
+    # finds it taken skips the put instead of waiting. Readers never lock: a slot's version is
+    # odd while it is written and bumped again when done, so a read that saw it odd or saw it
+    # change was (partly) of a write in progress and counts as a miss. The locks have to come
+    # from the start method the workers use, pass the DataLoader's multiprocessing_context.
+    def __init__(self, max_bytes, target_size, num_points=68, lock_stripes=64, multiprocessing_context=None,
+                 num_samples=None):
+        # the memory is allocated up front, so a split smaller than the budget only gets a slot per sample
+        slot_bytes = target_size * target_size * 3 + num_points * 2 * 4
+        self.slots = max(1, max_bytes // slot_bytes)
+        if num_samples is not None:
+            self.slots = max(1, min(num_samples, self.slots))
+        self.images = torch.zeros((self.slots, target_size, target_size, 3), dtype=torch.uint8).share_memory_()
+        self.landmarks = torch.zeros((self.slots, num_points, 2), dtype=torch.float32).share_memory_()
+        self.tags = torch.full((self.slots,), -1, dtype=torch.int64).share_memory_()
+        self.versions = torch.zeros((self.slots,), dtype=torch.int64).share_memory_()
+        context = multiprocessing_context
+        if context is None or isinstance(context, str):
+            context = multiprocessing.get_context(context)
+        self.locks = [context.Lock() for _ in range(min(self.slots, lock_stripes))]
+
+    def get(self, key):
+        slot = key % self.slots
+        version = self.versions[slot].item()
+        if version % 2 or self.tags[slot].item() != key:
+            return None
+        image = self.images[slot].numpy().copy()
+        landmarks = self.landmarks[slot].numpy().copy()
+        if self.versions[slot].item() != version:
+            return None
+        return image, landmarks
+
+    def put(self, key, image, landmarks):
+        slot = key % self.slots
+        if landmarks.shape != tuple(self.landmarks.shape[1:]) or image.shape != tuple(self.images.shape[1:]):
+            return
+        lock = self.locks[slot % len(self.locks)]
+        if not lock.acquire(block=False):
+            return
+        try:
+            self.versions[slot] += 1
+            self.tags[slot] = key
+            self.images[slot] = torch.from_numpy(image)
+            self.landmarks[slot] = torch.from_numpy(landmarks)
+            self.versions[slot] += 1
+        finally:
+            lock.release()
+
+
+class LandmarkDataset(Dataset):
+    # Reads raw dataset folders (or split manifests) and crops on the fly with preprocess.process,
+    # so no convert() run is needed. Returns (image, landmarks): a float32 CHW tensor in [0, 1]
+    # (BGR, as cv2 decodes it) and normalized (num_points, 2) landmarks, unless transform is given.
+    # cache='memory' keeps a private LRU per worker, so pair it with persistent_workers=True;
+    # cache='shared' survives worker restarts and is shared by all workers; give it the DataLoader's
+    # multiprocessing_context when that is not the default start method.
+    def __init__(self, data_dir, split='train', target_size=256, cache_bytes=1 << 30, cache='memory',
+                 num_points=68, transform=None, multiprocessing_context=None):
+        self.data_dir = data_dir
+        self.target_size = target_size
+        self.transform = transform
+        self.samples = list_samples(data_dir, split)
+        self.cache_bytes = cache_bytes
+        if cache == 'shared':
+            self._cache = SharedCropCache(cache_bytes, target_size, num_points,
+                                          multiprocessing_context=multiprocessing_context,
+                                          num_samples=len(self.samples))
+        elif cache == 'memory':
+            self._cache = None
+        else:
+            raise ValueError(f'Unknown cache type: {cache}')
+        self._shared = cache == 'shared'
+        self._pid = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _local_cache(self):
+        # a forked worker must not keep growing the parent's copy of the cache
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._cache = CropCache(self.cache_bytes)
+        return self._cache
+
+    def load(self, index):
+        cache = self._cache if self._shared else self._local_cache()
+        entry = cache.get(index) if cache is not None else None
+        if entry is None:
+            folder, image_name, label_name, _ = self.samples[index]
+            image, annotation = process(self.data_dir, folder, image_name, label_name, self.target_size)
+            entry = (image, numpy.asarray(annotation, dtype=numpy.float32))
+            if cache is not None:
+                cache.put(index, *entry)
+        return entry
+
+    def __getitem__(self, index):
+        image, landmarks = self.load(index)
+        if self.transform is not None:
+            return self.transform(image, landmarks)
+        image = torch.from_numpy(numpy.ascontiguousarray(image)).permute(2, 0, 1).float().div_(255)
+        return image, torch.from_numpy(landmarks)
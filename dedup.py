@@ -0,0 +1,238 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from catalog import IMAGE_EXTENSIONS, SPLIT_NAMES, is_output_dir, read_split_txt
+
+# Perceptual-hash index for near-duplicate frames and train/test leakage across the merged sources.
+#
+#     report = find_duplicates('/mnt/data/Projects/Datasets/IR/', report_path='duplicates.json')
+#
+# Every image gets a 64-bit DCT hash (cached in phash_cache.json by size and mtime). Pairs within
+# max_distance bits are found by multi-index hashing: the hash is cut into max_distance + 1 bands,
+# so two hashes that close agree exactly on at least one band, and only images sharing a band
+# value are compared, with vectorized popcounts. Matches are merged into clusters; a cluster with
+# both train and test members is a leak.
+
+PHASH_VERSION = 1
+REDUCED_GRAYSCALE_FLAGS = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                           8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:
+    _BYTE_COUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(x):
+        return _BYTE_COUNTS[x.view(np.uint8).reshape(*x.shape, 8)].sum(axis=-1)
+
+
+def phash(image_path):
+    # 32x32 grey thumbnail -> DCT -> 8x8 low frequencies against their median; only a thumbnail is
+    # needed, so large JPEGs are decoded at 1/2-1/8 scale
+    with Image.open(image_path) as img:
+        shortest = min(img.size)
+    factor = 1
+    for f in (2, 4, 8):
+        if shortest / f >= 64:
+            factor = f
+    image = cv2.imread(image_path, REDUCED_GRAYSCALE_FLAGS[factor] if factor > 1 else cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise IOError(f'cv2.imread failed for {image_path}')
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].ravel()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def _hash_job(path):
+    try:
+        return phash(path), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def _init_worker():
+    cv2.setNumThreads(1)
+
+
+def _split_of(path, data_dir):
+    # nearest train/test/val folder on the way from data_dir, e.g. dv2/train/x.png
+    parts = os.path.relpath(path, data_dir).split(os.sep)[:-1]
+    for part in reversed(parts):
+        if part in SPLIT_NAMES:
+            return part
+    return None
+
+
+def list_images(data_dir, skip=()):
+    # (path, source, split): source is the top-level folder (dv2, zerone2, ...), split comes from
+    # split.txt or the folder names, None when neither says. convert output is left out (see
+    # catalog.is_output_dir), skip names further top-level folders to leave out
+    images = []
+    for dirpath, dirnames, filenames in os.walk(data_dir):
+        top_level = dirpath == data_dir
+        dirnames[:] = [x for x in dirnames if not (top_level and x in skip)
+                       and not is_output_dir(os.path.join(dirpath, x), top_level)]
+        dirnames.sort()
+        manifest = {}
+        if 'split.txt' in filenames:
+            manifest = {os.path.join(dirpath, image): split
+                        for split, image, _ in read_split_txt(os.path.join(dirpath, 'split.txt'))}
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, filename)
+            relative = os.path.relpath(path, data_dir).split(os.sep)
+            source = relative[0] if len(relative) > 1 else ''
+            images.append((path, source, manifest.get(path) or _split_of(path, data_dir)))
+    return images
+
+
+def hash_images(paths, workers=8, cache_path=None):
+    # returns (uint64 hashes, ok mask, errors); only files changed since the cached run are decoded
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        if cached.get('version') == PHASH_VERSION:
+            cache = cached['entries']
+
+    hashes = np.zeros(len(paths), dtype=np.uint64)
+    ok = np.zeros(len(paths), dtype=bool)
+    identities = []
+    todo = []
+    for i, path in enumerate(paths):
+        st = os.stat(path)
+        identity = [st.st_size, st.st_mtime_ns]
+        identities.append(identity)
+        entry = cache.get(path)
+        if entry is not None and entry[:2] == identity:
+            hashes[i] = int(entry[2], 16)
+            ok[i] = True
+        else:
+            todo.append(i)
+
+    todo_paths = [paths[i] for i in todo]
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            results = list(executor.map(_hash_job, todo_paths,
+                                        chunksize=max(1, min(256, len(todo) // (workers * 4)))))
+    else:
+        results = [_hash_job(x) for x in todo_paths]
+    errors = {}
+    for i, (value, error) in zip(todo, results):
+        if error is None:
+            hashes[i] = value
+            ok[i] = True
+        else:
+            errors[paths[i]] = error
+
+    if cache_path is not None:
+        entries = {path: identity + [f'{int(value):016x}']
+                   for path, identity, value, good in zip(paths, identities, hashes, ok) if good}
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump({'version': PHASH_VERSION, 'entries': entries}, f)
+        os.replace(cache_path + '.tmp', cache_path)
+    return hashes, ok, errors
+
+
+def _bands(max_distance):
+    # max_distance + 1 contiguous bit ranges covering all 64 bits
+    edges = np.linspace(0, 64, max_distance + 2).round().astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def near_pairs(hashes, max_distance=4, block=4096):
+    # (i, j, distance) with i < j for every pair within max_distance bits, as int arrays
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    found = []
+    for low, high in _bands(max_distance):
+        keys = (hashes >> np.uint64(low)) & np.uint64((1 << (high - low)) - 1)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+            members = order[start:end]
+            values = hashes[members]
+            # bucket against itself, a block of rows at a time so a crowded band value stays bounded
+            for row in range(0, len(members), block):
+                distance = _popcount(values[row:row + block, None] ^ values[None, :])
+                i, j = np.nonzero(distance <= max_distance)
+                i += row
+                keep = i < j
+                found.append(np.stack([members[i[keep]], members[j[keep]], distance[i[keep] - row, j[keep]]], 1))
+    if not found:
+        return np.empty((0, 3), dtype=np.int64)
+    pairs = np.concatenate(found).astype(np.int64)
+    # a pair agreeing on several bands was found once per band
+    pairs[:, :2] = np.sort(pairs[:, :2], axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def clusters(count, pairs):
+    # connected components of the match graph, as lists of indices with at least two members
+    parent = np.arange(count)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j in pairs[:, :2].tolist():
+        a, b = find(i), find(j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+    roots = np.array([find(x) for x in range(count)]) if len(pairs) else parent
+    groups = {}
+    for index in np.flatnonzero(np.bincount(roots, minlength=count)[roots] > 1).tolist():
+        groups.setdefault(int(roots[index]), []).append(index)
+    return list(groups.values())
+
+
+def find_duplicates(data_dir, max_distance=4, workers=8, cache_path=None, report_path=None, skip=()):
+    start = time.perf_counter()
+    if cache_path is None:
+        cache_path = os.path.join(data_dir, 'phash_cache.json')
+    images = list_images(data_dir, skip)
+    paths = [path for path, _, _ in images]
+    hashes, ok, errors = hash_images(paths, workers, cache_path)
+    hashed = time.perf_counter()
+
+    valid = np.flatnonzero(ok)
+    pairs = near_pairs(hashes[valid], max_distance)
+    pairs[:, :2] = valid[pairs[:, :2]]
+
+    report_clusters = []
+    leaks = []
+    for members in clusters(len(paths), pairs):
+        splits = sorted({images[i][2] for i in members if images[i][2] is not None})
+        sources = sorted({images[i][1] for i in members})
+        cluster = {'size': len(members), 'splits': splits, 'sources': sources,
+                   'members': [{'image': paths[i], 'source': images[i][1], 'split': images[i][2],
+                                'hash': f'{int(hashes[i]):016x}'} for i in members]}
+        report_clusters.append(cluster)
+        if 'train' in splits and len(splits) > 1:
+            leaks.extend(paths[i] for i in members if images[i][2] not in (None, 'train'))
+    report_clusters.sort(key=lambda x: -x['size'])
+
+    report = {'data_dir': data_dir, 'images': len(paths), 'hashed': int(ok.sum()), 'max_distance': max_distance,
+              'pairs': len(pairs), 'exact_pairs': int((pairs[:, 2] == 0).sum()), 'clusters': len(report_clusters),
+              'duplicate_images': sum(x['size'] for x in report_clusters),
+              'cross_source_clusters': sum(1 for x in report_clusters if len(x['sources']) > 1),
+              'leaking_clusters': sum(1 for x in report_clusters if 'train' in x['splits'] and len(x['splits']) > 1),
+              'leaked_images': sorted(leaks), 'errors': errors,
+              'hash_s': hashed - start, 'elapsed': time.perf_counter() - start, 'duplicate_clusters': report_clusters}
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"{report['images']} images, {report['clusters']} duplicate clusters ({report['duplicate_images']} images), "
+          f"{report['leaking_clusters']} leaking across splits, {len(errors)} unreadable, {report['elapsed']:.1f}s")
+    return report
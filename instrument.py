@@ -0,0 +1,149 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+# Per-stage timers and counters for the preprocessing pipelines.
+#
+#     with instrument.profiling('summary.json', 'trace.json'):
+#         preprocess.convert(data_dir)
+#
+# Code under measurement does `with get_profiler().stage('decode'):` and
+# `get_profiler().count('bytes_read', n)`; while profiling is off these hit a no-op profiler.
+# Sinks are callables that receive every event as a dict, e.g. to forward to a metrics system.
+
+
+class _NullProfiler:
+    enabled = False
+
+    def __init__(self):
+        self._null = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self._null
+
+    def count(self, name, value=1):
+        pass
+
+
+class Profiler:
+    enabled = True
+
+    def __init__(self, trace=False, sinks=()):
+        self.trace = trace
+        self.sinks = list(sinks)
+        self.stages = {}
+        self.counters = Counter()
+        self.events = []
+        self.start = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._record(name, start, time.perf_counter_ns() - start)
+
+    def _record(self, name, start, duration, pid=None, tid=None):
+        with self._lock:
+            entry = self.stages.setdefault(name, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+            if self.trace or self.sinks:
+                event = {'type': 'stage', 'name': name, 'start': start, 'duration': duration,
+                         'pid': pid or os.getpid(), 'tid': tid or threading.get_ident()}
+                if self.trace:
+                    self.events.append(event)
+                for sink in self.sinks:
+                    sink(event)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+            for sink in self.sinks:
+                sink({'type': 'count', 'name': name, 'value': value})
+
+    def drain(self):
+        # hands everything recorded so far to another process (see merge) and starts over
+        with self._lock:
+            state = {'stages': self.stages, 'counters': dict(self.counters), 'events': self.events}
+            self.stages = {}
+            self.counters = Counter()
+            self.events = []
+        return state
+
+    def merge(self, state):
+        with self._lock:
+            for name, (calls, total, longest) in state['stages'].items():
+                entry = self.stages.setdefault(name, [0, 0, 0])
+                entry[0] += calls
+                entry[1] += total
+                entry[2] = max(entry[2], longest)
+            self.counters.update(state['counters'])
+            if self.trace:
+                self.events.extend(state['events'])
+            for sink in self.sinks:
+                for event in state['events']:
+                    sink(event)
+                for name, value in state['counters'].items():
+                    sink({'type': 'count', 'name': name, 'value': value})
+
+    def summary(self):
+        wall = (time.perf_counter_ns() - self.start) / 1e9
+        stages = {name: {'calls': calls, 'total_s': total / 1e9, 'mean_ms': total / calls / 1e6,
+                         'max_ms': longest / 1e6}
+                  for name, (calls, total, longest) in sorted(self.stages.items(), key=lambda x: -x[1][1])}
+        return {'wall_s': wall, 'stages': stages, 'counters': dict(self.counters)}
+
+    def dump_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def dump_chrome_trace(self, path):
+        # load in chrome://tracing or Perfetto
+        events = [{'name': e['name'], 'ph': 'X', 'ts': e['start'] / 1e3, 'dur': e['duration'] / 1e3,
+                   'pid': e['pid'], 'tid': e['tid']} for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+_null_profiler = _NullProfiler()
+_profiler = _null_profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+def enable(trace=False, sinks=()):
+    global _profiler
+    _profiler = Profiler(trace, sinks)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    profiler = _profiler
+    _profiler = _null_profiler
+    return profiler
+
+
+@contextlib.contextmanager
+def profiling(summary_path=None, trace_path=None, sinks=()):
+    profiler = enable(trace=trace_path is not None, sinks=sinks)
+    try:
+        yield profiler
+    finally:
+        disable()
+        if summary_path is not None:
+            profiler.dump_summary(summary_path)
+        if trace_path is not None:
+            profiler.dump_chrome_trace(trace_path)
@@ -0,0 +1,135 @@
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from instrument import get_profiler
+from pts import format_pts
+
+
+# Source parsers: each takes a label file and returns an (n_points, 2) array,
+# or None when the file holds no landmarks. They must stay module level so a
+# process pool can pickle them.
+
+def parse_json_keypoints(json_path):
+    with open(json_path, 'r') as json_file:
+        data = json.load(json_file)
+    keypoints = data["ObjectInfo"]["KeyPoints"]["Points"]
+    if len(keypoints) % 2 != 0:
+        raise ValueError("Unexpected number of landmark points. They should be in pairs.")
+    return np.asarray(keypoints).reshape(-1, 2)
+
+
+def parse_face68_xml(xml_path):
+    face_68_elem = ET.parse(xml_path).getroot().find('.//face_68')
+    if face_68_elem is None or 'points' not in face_68_elem.attrib:
+        return None
+    points = [point.split(',')[:2] for point in face_68_elem.attrib['points'].split(';')]
+    return np.array([point for point in points if len(point) == 2], dtype=np.float64).reshape(-1, 2)
+
+
+def indexed_points(elem):
+    # CVAT labeled points, ordered by their (relabeled) 'label' index
+    labels = []
+    coords = []
+    for point_elem in elem.findall('.//points'):
+        if 'points' in point_elem.attrib and 'label' in point_elem.attrib:
+            xy = point_elem.attrib['points'].split(',')
+            if len(xy) == 2:
+                labels.append(int(point_elem.attrib['label']))
+                coords.append(xy)
+    if not labels:
+        return None
+    # one argsort instead of a dict; of repeated labels the last one wins
+    labels = np.array(labels)[::-1]
+    _, last = np.unique(labels, return_index=True)
+    return np.array(coords, dtype=np.float64)[::-1][last]
+
+
+def parse_cvat_points(xml_path):
+    return indexed_points(ET.parse(xml_path).getroot())
+
+
+def _convert_one(parser, source_path, expected_points):
+    # with a process pool this runs in the workers, so 'parse' is only timed for workers=1
+    # or the thread executor
+    try:
+        with get_profiler().stage('parse'):
+            points = parser(source_path)
+    except Exception as e:
+        return source_path, None, f'{type(e).__name__}: {e}'
+    if points is None:
+        return source_path, None, None
+    warning = None
+    if expected_points is not None and len(points) != expected_points:
+        warning = f'Expected {expected_points} points, but found {len(points)}'
+    return source_path, format_pts(points), warning
+
+
+def _write_batch(batch):
+    profiler = get_profiler()
+    with profiler.stage('write'):
+        for pts_path, pts_content in batch:
+            with open(pts_path, 'w') as pts_file:
+                pts_file.write(pts_content)
+    if profiler.enabled:
+        profiler.count('bytes_written', sum(len(x) for _, x in batch))
+
+
+def convert_labels(source_paths, output_dir, parser, workers=1, executor='process', expected_points=None,
+                   batch_size=256, progress_interval=5.0, report_path=None):
+    os.makedirs(output_dir, exist_ok=True)
+    source_paths = list(source_paths)
+    report = {'total': len(source_paths), 'converted': 0, 'skipped': [], 'warnings': [], 'errors': []}
+    start = last_progress = time.perf_counter()
+
+    if workers > 1:
+        pool_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        pool = pool_class(max_workers=workers)
+        chunksize = max(1, min(64, len(source_paths) // (workers * 4)))
+        results = pool.map(_convert_one, [parser] * len(source_paths), source_paths,
+                           [expected_points] * len(source_paths), chunksize=chunksize)
+    else:
+        pool = None
+        results = (_convert_one(parser, x, expected_points) for x in source_paths)
+
+    profiler = get_profiler()
+    batch = []
+    try:
+        for done, (source_path, pts_content, message) in enumerate(results, start=1):
+            name = os.path.basename(source_path)
+            profiler.count('files')
+            if pts_content is None:
+                if message:
+                    profiler.count('failures')
+                report['errors' if message else 'skipped'].append({'file': name, 'message': message or 'No points'})
+            else:
+                if message:
+                    report['warnings'].append({'file': name, 'message': message})
+                pts_path = os.path.join(output_dir, os.path.splitext(name)[0] + '.pts')
+                batch.append((pts_path, pts_content))
+                report['converted'] += 1
+                if len(batch) >= batch_size:
+                    _write_batch(batch)
+                    batch = []
+
+            now = time.perf_counter()
+            if now - last_progress >= progress_interval:
+                print(f"{done}/{len(source_paths)} files, {report['converted']} converted, "
+                      f"{len(report['errors'])} errors, {done / (now - start):.0f} files/s")
+                last_progress = now
+        _write_batch(batch)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    report['elapsed'] = time.perf_counter() - start
+    print(f"Converted {report['converted']}/{report['total']} files in {report['elapsed']:.1f}s "
+          f"({len(report['skipped'])} skipped, {len(report['warnings'])} warnings, {len(report['errors'])} errors)")
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
@@ -0,0 +1,101 @@
+import numpy as np
+
+# iBUG 68-point layout, 1-based inclusive ranges as CVAT labels the skeletons
+index_ranges = {
+    'jaw': (1, 17),
+    'right_eyebrow': (18, 22),
+    'left_eyebrow': (23, 27),
+    'nose': (28, 36),
+    'right_eye': (37, 42),
+    'left_eye': (43, 48),
+    'mouth': (49, 60),
+    'inner_mouth': (61, 68)
+}
+
+# Mirror image of every region and where its k-th point (of n) lands there. Open curves run
+# in the opposite direction once mirrored; closed contours (eyes, lips) start from the mirrored
+# corner, and the nose keeps its bridge (first four points) and reverses the nostrils.
+mirror_regions = {
+    'jaw': ('jaw', lambda k, n: n - 1 - k),
+    'right_eyebrow': ('left_eyebrow', lambda k, n: n - 1 - k),
+    'left_eyebrow': ('right_eyebrow', lambda k, n: n - 1 - k),
+    'nose': ('nose', lambda k, n: k if k < 4 else n + 3 - k),
+    'right_eye': ('left_eye', lambda k, n: (n // 2 - k) % n),
+    'left_eye': ('right_eye', lambda k, n: (n // 2 - k) % n),
+    'mouth': ('mouth', lambda k, n: (n // 2 - k) % n),
+    'inner_mouth': ('inner_mouth', lambda k, n: (n // 2 - k) % n),
+}
+
+
+def flip_permutation(ranges=None):
+    # 0-based permutation p such that points[p] is the landmark set of the horizontally flipped face
+    ranges = index_ranges if ranges is None else ranges
+    permutation = np.arange(max(end for _, end in ranges.values()))
+    for region, (start, end) in ranges.items():
+        mirror, position = mirror_regions[region]
+        mirror_start = ranges[mirror][0]
+        n = end - start + 1
+        for k in range(n):
+            permutation[start - 1 + k] = mirror_start - 1 + position(k, n)
+    return permutation
+
+
+# Array versions of the per-point work done across the converters. Landmarks are (..., K, 2)
+# arrays, so one call handles a single face or a whole (N, K, 2) dataset.
+
+def scheme_index(source_order, target_order):
+    # index for remap() taking points listed in source_order to target_order; both are sequences of
+    # point ids (names, vendor numbers, ...), ids missing from the source map to -1
+    position = {point: i for i, point in enumerate(source_order)}
+    return np.array([position.get(point, -1) for point in target_order], dtype=np.int64)
+
+
+def region_index(regions, ranges=None):
+    # target (0-based, 68-point) index of every point when regions = [(name, count), ...] are
+    # concatenated in that order, as a CVAT export lists its skeletons; -1 for unknown regions
+    ranges = index_ranges if ranges is None else ranges
+    parts = []
+    for name, count in regions:
+        if name in ranges:
+            parts.append(np.arange(ranges[name][0] - 1, ranges[name][0] - 1 + count))
+        else:
+            parts.append(np.full(count, -1))
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+
+def remap(landmarks, index, fill=np.nan):
+    # points[..., index[j], :] for every j; index -1 gives fill (a point the source scheme lacks)
+    landmarks = np.asarray(landmarks)
+    index = np.asarray(index)
+    missing = index < 0
+    out = landmarks[..., np.where(missing, 0, index), :]
+    if missing.any():
+        out = out.astype(np.result_type(out.dtype, type(fill)))
+        out[..., missing, :] = fill
+    return out
+
+
+def expand_boxes(landmarks, image_sizes, scale=1.1):
+    # crop boxes (..., 4) as x_min, y_min, x_max, y_max ints: the landmark box grown by scale around
+    # its centre and clamped to the image, with the same integer steps preprocess.process always used.
+    # image_sizes is (width, height), or (..., 2) per face
+    landmarks = np.asarray(landmarks)
+    low = np.nanmin(landmarks, axis=-2).astype(np.int64)
+    high = np.nanmax(landmarks, axis=-2).astype(np.int64)
+    size = high - low
+    low = low - np.trunc((scale - 1) / 2 * size).astype(np.int64)
+    size = np.trunc(size * scale).astype(np.int64)
+    low = np.maximum(low, 0)
+    size = np.minimum(size, np.asarray(image_sizes, dtype=np.int64) - low - 1)
+    return np.concatenate([low, low + size], axis=-1)
+
+
+def normalize(landmarks, boxes):
+    # coordinates relative to the box, 0..1 inside it
+    boxes = np.asarray(boxes)[..., None, :]
+    return (np.asarray(landmarks) - boxes[..., :2]) / (boxes[..., 2:] - boxes[..., :2])
+
+
+def denormalize(normalized, boxes):
+    boxes = np.asarray(boxes)[..., None, :]
+    return np.asarray(normalized) * (boxes[..., 2:] - boxes[..., :2]) + boxes[..., :2]
@@ -0,0 +1,79 @@
+import json
+import os
+
+import numpy as np
+
+# A store is three files sharing a prefix (e.g. <data_dir>/train):
+#   <prefix>.landmarks.bin   contiguous float32 array of shape (N, points, 2)
+#   <prefix>.landmarks.json  shape and dtype of the .bin file
+#   <prefix>.paths.txt       image path of row i on line i
+# The .bin file can be opened directly with numpy.memmap, no parsing needed.
+
+
+class LandmarkStoreWriter:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.count = 0
+        self.points = None
+        self._bin = open(prefix + '.landmarks.bin', 'wb')
+        self._paths = open(prefix + '.paths.txt', 'w')
+
+    def check(self, image_path, annotation):
+        # every row must have the point count of the first one
+        if self.points is not None and len(annotation) != self.points:
+            raise ValueError(f'{image_path} has {len(annotation)} points, expected {self.points}')
+
+    def append(self, image_path, annotation):
+        annotation = np.asarray(annotation, dtype=np.float32).reshape(-1, 2)
+        self.check(image_path, annotation)
+        if self.points is None:
+            self.points = len(annotation)
+        self._bin.write(annotation.tobytes())
+        self._paths.write(image_path + '\n')
+        self.count += 1
+
+    def close(self):
+        if self._bin.closed:
+            return
+        self._bin.close()
+        self._paths.close()
+        with open(self.prefix + '.landmarks.json', 'w') as f:
+            json.dump({'count': self.count, 'points': self.points or 0, 'dtype': 'float32'}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_store(prefix, image_paths, landmarks):
+    with LandmarkStoreWriter(prefix) as writer:
+        for image_path, annotation in zip(image_paths, landmarks):
+            writer.append(image_path, annotation)
+
+
+def load_store(prefix, mode='r'):
+    with open(prefix + '.landmarks.json', 'r') as f:
+        header = json.load(f)
+    with open(prefix + '.paths.txt', 'r') as f:
+        image_paths = f.read().splitlines()
+
+    shape = (header['count'], header['points'], 2)
+    if header['count'] == 0:
+        return image_paths, np.zeros(shape, dtype=header['dtype'])
+    landmarks = np.memmap(prefix + '.landmarks.bin', dtype=header['dtype'], mode=mode, shape=shape)
+    return image_paths, landmarks
+
+
+def text_to_store(txt_path, prefix=None):
+    # converts an existing train.txt/test.txt written by preprocess.convert
+    if prefix is None:
+        prefix = os.path.splitext(txt_path)[0]
+    with open(txt_path, 'r') as f, LandmarkStoreWriter(prefix) as writer:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            writer.append(parts[0], np.array(parts[1:], dtype=np.float64))
+    return prefix
@@ -1,136 +1,577 @@
-import copy
-import math
+import collections
+import hashlib
+import heapq
+import json
 import os
-import random
+from concurrent.futures import Future, ProcessPoolExecutor
 
 import cv2
 import numpy
-import torch
-from PIL import Image
-from PIL import ImageFilter
 
+import instrument
+from catalog import image_header, read_split_txt, update_catalog
+from crop_archive import CropArchiveWriter, encode_crop
+from instrument import get_profiler
+from landmark_schemes import expand_boxes, normalize
+from landmark_store import LandmarkStoreWriter
+from pts import read_pts
 
-def process(data_dir, folder, image_name, label_name, target_size):
-    image_path = os.path.join(data_dir, folder, image_name)
-    label_path = os.path.join(data_dir, folder, label_name)
+MANIFEST_VERSION = 2
+DATASETS = ['dv2', 'dibox2', 'nir_face2', 'prevent', 'zerone2']
+REDUCED_DECODE_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def _reduced_crop(image_path, box, image_size, target_size):
+    # JPEG can be decoded at 1/2, 1/4 or 1/8 scale straight from the DCT coefficients;
+    # pick the largest reduction that still leaves at least target_size pixels in the box
+    x_min, y_min, x_max, y_max = box
+    image_width, image_height = image_size
+    factor = 1
+    while factor < 8 and min(x_max - x_min, y_max - y_min) / (factor * 2) >= target_size:
+        factor *= 2
+    if factor == 1:
+        return None
+    image = cv2.imread(image_path, REDUCED_DECODE_FLAGS[factor])
+    if image is None or abs(image.shape[1] - image_width / factor) > 1 or abs(image.shape[0] - image_height / factor) > 1:
+        return None
+
+    # reduced pixel i covers full-resolution pixels [i * factor, (i + 1) * factor), so map every
+    # output pixel centre through the box into the reduced image at sub-pixel precision
+    # instead of rounding the box to whole reduced pixels
+    sx = (x_max - x_min) / target_size
+    sy = (y_max - y_min) / target_size
+    matrix = numpy.array([[sx / factor, 0, (x_min + 0.5 * sx - 0.5 - (factor - 1) / 2) / factor],
+                          [0, sy / factor, (y_min + 0.5 * sy - 0.5 - (factor - 1) / 2) / factor]])
+    return cv2.warpAffine(image, matrix, (target_size, target_size),
+                          flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
 
-    with open(label_path, 'r') as f:
-        if folder.split('/')[0] == 'dv2':
-            annotation = f.readlines()[3:-1]
-        elif folder.split('/')[0] == 'dibox2' or folder.split('/')[0] == 'nir_face2':
-            annotation = f.readlines()
-        elif folder.split('/')[0] == 'prevent':
-            annotation = f.readlines()[3:-3]
-        elif folder.split('/')[0] == 'zerone2':
-            annotation = f.readlines()[3:-1]
+
+def _resize_pyramid(region, largest_crop, sizes):
+    # every size comes from the same crop: the largest straight from the region, smaller ones from
+    # the smallest already produced crop at least twice their size, otherwise from the region too
+    crops = {max(sizes): largest_crop}
+    for size in sorted(sizes, reverse=True)[1:]:
+        sources = [s for s in crops if s >= 2 * size]
+        if sources:
+            crops[size] = cv2.resize(crops[min(sources)], (size, size), interpolation=cv2.INTER_AREA)
+        elif region is not None:
+            crops[size] = cv2.resize(region, (size, size))
         else:
-            print("Error check label")
+            crops[size] = cv2.resize(largest_crop, (size, size), interpolation=cv2.INTER_AREA)
+    return crops
+
+
+def process(data_dir, folder, image_name, label_name, target_size, reduced_decode=False):
+    # target_size may be a list of sizes, then the crops come back as a {size: crop} dict.
+    # reduced_decode=True decodes large JPEG faces at 1/2-1/8 scale (see _reduced_crop): much faster,
+    # but the crops differ slightly (within interpolation tolerance) from a full decode
+    sizes = list(target_size) if isinstance(target_size, (list, tuple)) else [target_size]
+    image_path = os.path.join(data_dir, folder, image_name)
+    label_path = os.path.join(data_dir, folder, label_name)
+    profiler = get_profiler()
+    if profiler.enabled:
+        profiler.count('files')
+        profiler.count('bytes_read', os.path.getsize(image_path) + os.path.getsize(label_path))
 
-        annotation = [x.strip().split() for x in annotation]
-        annotation = [[int(float(x[0])), int(float(x[1]))] for x in annotation]
+    # the {...} block is located by read_pts, so the dataset-specific header/footer
+    # lengths (dv2, prevent, zerone2) and the bare dibox2/nir_face2 files all parse the same
+    with profiler.stage('read_label'):
+        points = read_pts(label_path).astype(int)
 
-        image = cv2.imread(image_path)
+    # the box only needs the image size, so decoding can wait until we know how much is kept
+    image = None
+    image_format = None
+    # IMREAD_REDUCED_* only speeds up JPEG, other formats are decoded once in full
+    if reduced_decode and image_name.lower().endswith(('.jpg', '.jpeg')):
+        with profiler.stage('read_header'):
+            image_width, image_height, image_format = image_header(image_path)
+    else:
+        with profiler.stage('decode'):
+            image = cv2.imread(image_path)
         image_height, image_width, _ = image.shape
-        anno_x = [x[0] for x in annotation]
-        anno_y = [x[1] for x in annotation]
-        x_min = min(anno_x)
-        y_min = min(anno_y)
-        x_max = max(anno_x)
-        y_max = max(anno_y)
-        box_w = x_max - x_min
-        box_h = y_max - y_min
-        scale = 1.1
-        x_min -= int((scale - 1) / 2 * box_w)
-        y_min -= int((scale - 1) / 2 * box_h)
-        box_w *= scale
-        box_h *= scale
-        box_w = int(box_w)
-        box_h = int(box_h)
-        x_min = max(x_min, 0)
-        y_min = max(y_min, 0)
-        box_w = min(box_w, image_width - x_min - 1)
-        box_h = min(box_h, image_height - y_min - 1)
-        annotation = [[(x - x_min) / box_w, (y - y_min) / box_h] for x, y in annotation]
-
-        x_max = x_min + box_w
-        y_max = y_min + box_h
-        image_crop = image[y_min:y_max, x_min:x_max, :]
-        image_crop = cv2.resize(image_crop, (target_size, target_size))
+    # landmark box grown by 1.1 and clamped to the image, see landmark_schemes.expand_boxes
+    box = expand_boxes(points, (image_width, image_height))
+    x_min, y_min, x_max, y_max = box.tolist()
+    if x_max == x_min or y_max == y_min:
+        raise ZeroDivisionError('empty face box')
+    annotation = normalize(points, box).tolist()
+
+    # normalized landmarks are relative to the box, so they hold for a crop taken at any decode scale
+    region = image_crop = None
+    if image_format == 'JPEG':
+        with profiler.stage('decode_reduced'):
+            image_crop = _reduced_crop(image_path, (x_min, y_min, x_max, y_max), (image_width, image_height),
+                                       max(sizes))
+    if image_crop is None:
+        if image is None:
+            with profiler.stage('decode'):
+                image = cv2.imread(image_path)
+        with profiler.stage('crop_resize'):
+            region = image[y_min:y_max, x_min:x_max, :]
+            image_crop = cv2.resize(region, (max(sizes), max(sizes)))
+    if not isinstance(target_size, (list, tuple)):
         return image_crop, annotation
+    with profiler.stage('resize_pyramid'):
+        return _resize_pyramid(region, image_crop, sizes), annotation
 
 
-def convert(data_dir, target_size=256):
-    if not os.path.exists(os.path.join(data_dir, 'images', 'train')):
-        os.makedirs(os.path.join(data_dir, 'images', 'train'))
-    if not os.path.exists(os.path.join(data_dir, 'images', 'test')):
-        os.makedirs(os.path.join(data_dir, 'images', 'test'))
+def _process_job(job):
+    data_dir, folder, image_name, label_name, sizes, image_crop_names, archive, _, reduced_decode = job
+    profiler = get_profiler()
+    data = []
+    try:
+        image_crops, annotation = process(data_dir, folder, image_name, label_name, list(sizes), reduced_decode)
+        for size, image_crop_name in zip(sizes, image_crop_names):
+            if archive:
+                # encoding happens here so the main process only appends bytes to the shard
+                with profiler.stage('encode'):
+                    data.append(encode_crop(image_crop_name, image_crops[size], archive))
+                profiler.count('bytes_written', len(data[-1]))
+            else:
+                with profiler.stage('write'):
+                    if not cv2.imwrite(image_crop_name, image_crops[size]):
+                        raise IOError(f'cv2.imwrite failed for {image_crop_name}')
+                if profiler.enabled:
+                    profiler.count('bytes_written', os.path.getsize(image_crop_name))
+    except Exception as e:
+        profiler.count('failures')
+        return image_crop_names[0], None, f'{type(e).__name__}: {e}', None
+    return image_crop_names[0], annotation, None, data
 
-    folders = ['dv2/train', 'dibox2/train', 'nir_face2/train', 'prevent/train', 'zerone2/train']
-    annotations = {}
-    for folder in folders:
-        filenames = sorted(os.listdir(os.path.join(data_dir, folder)))
-        label_files = [x for x in filenames if '.pts' in x]
-        image_files = [x for x in filenames if '.pts' not in x]
-        assert len(image_files) == len(label_files)
-        for image_name, label_name in zip(image_files, label_files):
-            image_crop_name = folder.replace('/', '_') + '_' + image_name
-            image_crop_name = os.path.join(data_dir, 'images', 'train', image_crop_name)
-
-            image_crop, annotation = process(data_dir, folder, image_name, label_name, target_size)
-            cv2.imwrite(image_crop_name, image_crop)
-            annotations[image_crop_name] = annotation
-    with open(os.path.join(data_dir, 'train.txt'), 'w') as f:
-        for image_crop_name, annotation in annotations.items():
-            f.write(image_crop_name + ' ')
-            for x, y in annotation:
-                f.write(str(x) + ' ' + str(y) + ' ')
-            f.write('\n')
-
-    annotations = {}
-    folders = ['dv2/test', 'dibox2/test', 'nir_face2/test', 'prevent/test', 'zerone2/test']
-    for folder in folders:
+
+def _pool_job(job):
+    # pool workers ship what they measured back with every result, see _init_worker
+    result = _process_job(job)
+    profiler = get_profiler()
+    return result, profiler.drain() if profiler.enabled else None
+
+
+def _init_worker(profile=False, trace=False):
+    # one OpenCV thread per process, the pool already keeps every core busy
+    cv2.setNumThreads(1)
+    if profile:
+        instrument.enable(trace)
+
+
+def _file_identity(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _load_manifest(data_dir, part=None):
+    manifest_path = os.path.join(data_dir, f'convert_manifest.{part}.json' if part else 'convert_manifest.json')
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    return manifest['entries']
+
+
+def _save_manifest(data_dir, entries, part=None):
+    manifest_path = os.path.join(data_dir, f'convert_manifest.{part}.json' if part else 'convert_manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'entries': entries}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _split_pairs(data_dir, name, split, catalog=None):
+    manifest_path = os.path.join(data_dir, name, 'split.txt')
+    if os.path.exists(manifest_path):
+        return name, [(image, label) for x, image, label in read_split_txt(manifest_path) if x == split]
+    folder = f'{name}/{split}'
+    if catalog is not None and catalog.has_folder(os.path.join(data_dir, folder)):
+        # pairs by file stem from catalog.py, a file without its counterpart is reported and left out
+        rows = catalog.folder_rows(os.path.join(data_dir, folder))
+        images = catalog.columns['image'][rows]
+        labels = catalog.columns['label'][rows]
+        paired = (images != b'') & (labels != b'')
+        if not paired.all():
+            print(f'{folder}: {int((~paired).sum())} files without an image or label are skipped')
+        return folder, sorted((x.decode(), y.decode()) for x, y in zip(images[paired], labels[paired]))
+    with get_profiler().stage('list'):
         filenames = sorted(os.listdir(os.path.join(data_dir, folder)))
-        label_files = [x for x in filenames if '.pts' in x]
-        image_files = [x for x in filenames if '.pts' not in x]
-        assert len(image_files) == len(label_files)
-        for image_name, label_name in zip(image_files, label_files):
-            image_crop_name = folder.replace('/', '_') + '_' + image_name
-            image_crop_name = os.path.join(data_dir, 'images', 'test', image_crop_name)
-
-            image_crop, annotation = process(data_dir, folder, image_name, label_name, target_size)
-            cv2.imwrite(image_crop_name, image_crop)
-            annotations[image_crop_name] = annotation
-    with open(os.path.join(data_dir, 'test.txt'), 'w') as f:
-        for image_crop_name, annotation in annotations.items():
-            f.write(image_crop_name + ' ')
-            for x, y in annotation:
-                f.write(str(x) + ' ' + str(y) + ' ')
-            f.write('\n')
-
-    with open(os.path.join(data_dir, 'test.txt'), 'r') as f:
-        annotations = f.readlines()
-    with open(os.path.join(data_dir, 'test_common.txt'), 'w') as f:
-        for annotation in annotations:
-            if 'ibug' not in annotation:
-                f.write(annotation)
-    with open(os.path.join(data_dir, 'test_challenge.txt'), 'w') as f:
-        for annotation in annotations:
-            if 'ibug' in annotation:
-                f.write(annotation)
-
-    with open(os.path.join(data_dir, 'train.txt'), 'r') as f:
-        annotations = f.readlines()
-    annotations = [x.strip().split()[1:] for x in annotations]
-    annotations = [[float(x) for x in anno] for anno in annotations]
-    annotations = numpy.array(annotations)
-    mean_face = [str(x) for x in numpy.mean(annotations, axis=0).tolist()]
-
-    with open(os.path.join(data_dir, 'indices.txt'), 'w') as f:
-        f.write(' '.join(mean_face))
-
-
-data_dir = '/mnt/data/Projects/Datasets/IR/'
-convert(data_dir)
+    label_files = [x for x in filenames if '.pts' in x]
+    image_files = [x for x in filenames if '.pts' not in x]
+    assert len(image_files) == len(label_files)
+    return folder, list(zip(image_files, label_files))
+
+
+def list_samples(data_dir, split, catalog=None):
+    # (folder, image_name, label_name, crop_name) for every sample of a split, in convert order;
+    # crops keep the <dataset>_<split>_ prefix whether the split comes from folders or a manifest
+    samples = []
+    for name in DATASETS:
+        folder, pairs = _split_pairs(data_dir, name, split, catalog)
+        for image_name, label_name in pairs:
+            samples.append((folder, image_name, label_name, f'{name}_{split}_{image_name}'))
+    return samples
+
+
+def shard_of(crop_name, shard_count):
+    # stable across hosts and Python runs, unlike hash()
+    return int(hashlib.sha1(crop_name.encode()).hexdigest()[:15], 16) % shard_count
+
+
+def _split_jobs(data_dir, split, output_dirs, archive=None, shard_index=None, shard_count=1, catalog=None,
+                reduced_decode=False):
+    sizes = tuple(output_dirs)
+    for ordinal, (folder, image_name, label_name, crop_name) in enumerate(list_samples(data_dir, split, catalog)):
+        if shard_index is not None and shard_of(crop_name, shard_count) != shard_index:
+            continue
+        image_crop_names = tuple(os.path.join(output_dirs[size], 'images', split, crop_name) for size in sizes)
+        yield data_dir, folder, image_name, label_name, sizes, image_crop_names, archive, ordinal, reduced_decode
+
+
+def _source_key(job):
+    data_dir, folder, image_name, label_name, sizes = job[:5]
+    return {'image': _file_identity(os.path.join(data_dir, folder, image_name)),
+            'label': _file_identity(os.path.join(data_dir, folder, label_name)),
+            'target_size': list(sizes), 'reduced_decode': job[8]}
+
+
+class LandmarkStats:
+    # online per-coordinate statistics over flattened (x0, y0, x1, y1, ...) rows. The sum is kept
+    # in fixed point (int64, 2**-32 resolution), which makes the mean exact and independent of the
+    # order rows arrive in, so merged shard accumulators give the same indices.txt as one host.
+    FIXED_BITS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.sum = None
+        self.running_mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+
+    def update(self, annotation):
+        row = numpy.asarray(annotation, dtype=numpy.float64).ravel()
+        if self.count == 0:
+            self.sum = numpy.zeros(row.shape, dtype=numpy.int64)
+            self.running_mean = numpy.zeros_like(row)
+            self.m2 = numpy.zeros_like(row)
+            self.min = row.copy()
+            self.max = row.copy()
+        self.count += 1
+        self.sum += numpy.rint(numpy.ldexp(row, self.FIXED_BITS)).astype(numpy.int64)
+        # Welford update for the variance
+        delta = row - self.running_mean
+        self.running_mean += delta / self.count
+        self.m2 += delta * (row - self.running_mean)
+        numpy.minimum(self.min, row, out=self.min)
+        numpy.maximum(self.max, row, out=self.max)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.__dict__.update({k: (v.copy() if isinstance(v, numpy.ndarray) else v) for k, v in other.__dict__.items()})
+            return
+        count = self.count + other.count
+        delta = other.running_mean - self.running_mean
+        self.m2 += other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.running_mean += delta * (other.count / count)
+        self.sum += other.sum
+        self.count = count
+        numpy.minimum(self.min, other.min, out=self.min)
+        numpy.maximum(self.max, other.max, out=self.max)
+
+    # mean and var are None until a row has been seen, the row length is unknown before that
+    @property
+    def mean(self):
+        if self.count == 0:
+            return None
+        return numpy.ldexp(self.sum / self.count, -self.FIXED_BITS)
+
+    @property
+    def var(self):
+        if self.count == 0:
+            return None
+        return self.m2 / self.count
+
+    def to_dict(self):
+        if self.count == 0:
+            return {'count': 0, 'mean': None, 'var': None, 'min': None, 'max': None}
+        return {'count': self.count, 'mean': self.mean.tolist(), 'var': self.var.tolist(),
+                'min': self.min.tolist(), 'max': self.max.tolist()}
+
+    def state(self):
+        # lossless form for partial accumulators; floats survive json via repr
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count, 'sum': self.sum.tolist(), 'running_mean': self.running_mean.tolist(),
+                'm2': self.m2.tolist(), 'min': self.min.tolist(), 'max': self.max.tolist()}
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls()
+        stats.count = state['count']
+        if stats.count:
+            stats.sum = numpy.array(state['sum'], dtype=numpy.int64)
+            for name in ('running_mean', 'm2', 'min', 'max'):
+                setattr(stats, name, numpy.array(state[name], dtype=numpy.float64))
+        return stats
+
+
+def _resolve(result):
+    if not isinstance(result, Future):
+        return result
+    result, measured = result.result()
+    if measured is not None:
+        get_profiler().merge(measured)
+    return result
+
+
+def _run_jobs(jobs, executor, window, manifest=None, keys=None):
+    # yields (job, result, processed) in job order; at most `window` results are in flight or
+    # buffered at any time, so memory does not grow with the dataset
+    pending = collections.deque()
+    for job in jobs:
+        image_crop_name = job[5][0]
+        entry = None
+        if manifest is not None:
+            keys[image_crop_name] = _source_key(job)
+            entry = manifest.get(image_crop_name)
+            if entry is not None and (entry['key'] != keys[image_crop_name] or
+                                      not all(os.path.exists(x) for x in entry['outputs'])):
+                entry = None
+        if entry is not None:
+            pending.append((job, (image_crop_name, entry['annotation'], None, None), False))
+        elif executor is None:
+            pending.append((job, _process_job(job), True))
+        else:
+            pending.append((job, executor.submit(_pool_job, job), True))
+        while pending and (len(pending) >= window or not isinstance(pending[0][1], Future)):
+            job, result, processed = pending.popleft()
+            yield job, _resolve(result), processed
+    while pending:
+        job, result, processed = pending.popleft()
+        yield job, _resolve(result), processed
+
+
+class _SplitOutput:
+    # annotation files, archive and landmark store of one split at one target size; a shard
+    # only writes shards/<split>.<part>.txt with the global ordinal in front of every row
+    def __init__(self, output_dir, split, target_size, store=False, archive=None, part=None):
+        self.split = split
+        self.part = part
+        self.archive = None
+        if archive:
+            self.archive = CropArchiveWriter(os.path.join(output_dir, 'images', split), archive,
+                                             shape=(target_size, target_size, 3))
+        self.store = LandmarkStoreWriter(os.path.join(output_dir, split)) if store else None
+        if part:
+            os.makedirs(os.path.join(output_dir, 'shards'), exist_ok=True)
+            self.files = [open(os.path.join(output_dir, 'shards', f'{split}.{part}.txt'), 'w')]
+            return
+        self.files = [open(os.path.join(output_dir, f'{split}.txt'), 'w')]
+        if split == 'test':
+            self.files += [open(os.path.join(output_dir, 'test_common.txt'), 'w'),
+                           open(os.path.join(output_dir, 'test_challenge.txt'), 'w')]
+
+    def write(self, image_crop_name, coordinates, annotation, data, ordinal=None):
+        row = image_crop_name + ' ' + coordinates + '\n'
+        if self.part:
+            self.files[0].write(f'{ordinal}\t{row}')
+            return
+        self.files[0].write(row)
+        if self.split == 'test':
+            self.files[2 if 'ibug' in row else 1].write(row)
+        if self.archive is not None:
+            self.archive.append_bytes(os.path.basename(image_crop_name), data)
+        if self.store is not None:
+            self.store.append(image_crop_name, annotation)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.store is not None:
+            self.store.close()
+
+
+def _convert_split(data_dir, split, output_dirs, executor, window, stats=None, manifest=None, store=False,
+                   archive=None, shard_index=None, shard_count=1, catalog=None, reduced_decode=False):
+    jobs = _split_jobs(data_dir, split, output_dirs, archive, shard_index, shard_count, catalog, reduced_decode)
+    part = _part_name(shard_index, shard_count)
+    outputs = [_SplitOutput(output_dir, split, size, store, archive, part) for size, output_dir in output_dirs.items()]
+
+    # with a manifest only new or changed (image, label, target_size) pairs are processed
+    keys = {}
+    failures = []
+    total = processed_count = 0
+    try:
+        for job, (image_crop_name, annotation, error, data), processed in _run_jobs(jobs, executor, window,
+                                                                                     manifest, keys):
+            total += 1
+            processed_count += processed
+            if error is None and store:
+                # a row the store can not take is left out of the text files too, so they stay aligned
+                try:
+                    for output in outputs:
+                        output.store.check(image_crop_name, annotation)
+                except ValueError as e:
+                    error = f'{type(e).__name__}: {e}'
+            if error is not None:
+                print(f'Failed {image_crop_name}: {error}')
+                failures.append((image_crop_name, error))
+                if manifest is not None:
+                    manifest.pop(image_crop_name, None)
+                continue
+
+            # the normalized landmarks are the same for every size, format them once
+            coordinates = ''.join(str(x) + ' ' + str(y) + ' ' for x, y in annotation)
+            crop_name = os.path.basename(image_crop_name)
+            image_crop_names = [os.path.join(x, 'images', split, crop_name) for x in output_dirs.values()]
+            for i, output in enumerate(outputs):
+                output.write(image_crop_names[i], coordinates, annotation, data[i] if data else None, job[7])
+            if stats is not None:
+                stats.update(annotation)
+            if manifest is not None:
+                manifest[image_crop_name] = {'key': keys[image_crop_name], 'annotation': annotation,
+                                             'outputs': image_crop_names}
+    finally:
+        for output in outputs:
+            output.close()
+
+    if manifest is not None:
+        # drop crops whose sources are gone
+        prefix = os.path.join(next(iter(output_dirs.values())), 'images', split, '')
+        for image_crop_name in [x for x in manifest if x.startswith(prefix) and x not in keys]:
+            for output_path in manifest[image_crop_name]['outputs']:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            del manifest[image_crop_name]
+        print(f'{split}: processed {processed_count} of {total} images')
+    return failures
+
+
+def _part_name(shard_index, shard_count):
+    if shard_index is None:
+        return None
+    return f'part-{shard_index:05d}-of-{shard_count:05d}'
+
+
+def _output_dirs(data_dir, target_size):
+    # a list of sizes is produced from one decode per image, each size in its own <data_dir>/<size>/
+    if isinstance(target_size, (list, tuple)):
+        return {size: os.path.join(data_dir, str(size)) for size in sorted(set(target_size), reverse=True)}
+    return {target_size: data_dir}
+
+
+def convert(data_dir, target_size=256, workers=1, incremental=False, store=False, archive=None,
+            shard_index=None, shard_count=1, catalog=None, reduced_decode=False):
+    # archive='encoded' or 'raw' packs the crops into images/<split>-*.shard files
+    # instead of one file each, see crop_archive.py. reduced_decode=True trades exact crops for a
+    # faster decode of large JPEG faces, see process()
+    if archive and incremental:
+        raise ValueError('incremental conversion needs per-file crops, it can not be combined with archive')
+    # shard_index/shard_count: this run handles only its part of the samples and writes partial
+    # annotation files and statistics under shards/, merge_shards() then builds the final files
+    if shard_index is not None and not 0 <= shard_index < shard_count:
+        raise ValueError(f'shard_index must be in [0, {shard_count})')
+    if shard_index is not None and (archive or store):
+        raise ValueError('sharded runs write per-file crops; build archives or stores after merge_shards')
+    part = _part_name(shard_index, shard_count)
+    # catalog=True refreshes and uses data_dir/catalog.npz (see catalog.py) for the sample lists,
+    # a Catalog is used as given; by default the folders are listed directly
+    if catalog is True:
+        catalog = update_catalog(data_dir)
+
+    output_dirs = _output_dirs(data_dir, target_size)
+    for output_dir in output_dirs.values():
+        for split in ('train', 'test'):
+            os.makedirs(os.path.join(output_dir, 'images', split), exist_ok=True)
+
+    # workers=1 keeps everything in this process, workers=None uses every core
+    executor = None
+    if workers is None or workers > 1:
+        profiler = get_profiler()
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                       initargs=(profiler.enabled, getattr(profiler, 'trace', False)))
+    window = 8 * (workers or os.cpu_count())
+    # incremental=True keeps convert_manifest.json in data_dir and only redoes what changed
+    manifest = _load_manifest(data_dir, part) if incremental else None
+    stats = LandmarkStats()
+    try:
+        failures = _convert_split(data_dir, 'train', output_dirs, executor, window, stats, manifest, store, archive,
+                                  shard_index, shard_count, catalog, reduced_decode)
+        failures += _convert_split(data_dir, 'test', output_dirs, executor, window, None, manifest, store, archive,
+                                   shard_index, shard_count, catalog, reduced_decode)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if manifest is not None:
+            _save_manifest(data_dir, manifest, part)
+    if failures:
+        print(f'{len(failures)} images failed to convert')
+
+    if part:
+        for output_dir in output_dirs.values():
+            with open(os.path.join(output_dir, 'shards', f'stats.{part}.json'), 'w') as f:
+                json.dump(stats.state(), f)
+        return
+
+    _write_mean_face(output_dirs, stats)
+
+
+def _write_mean_face(output_dirs, stats):
+    for output_dir in output_dirs.values():
+        indices_path = os.path.join(output_dir, 'indices.txt')
+        if stats.count == 0:
+            # no mean face without train rows; a stale one from an earlier run must not stay behind
+            print(f'{output_dir}: the train split has no samples, indices.txt is not written')
+            if os.path.exists(indices_path):
+                os.remove(indices_path)
+        else:
+            with open(indices_path, 'w') as f:
+                f.write(' '.join(str(x) for x in stats.mean.tolist()))
+        with open(os.path.join(output_dir, 'landmark_stats.json'), 'w') as f:
+            json.dump(stats.to_dict(), f)
+
+
+def _read_part(path):
+    with open(path, 'r') as f:
+        for line in f:
+            ordinal, row = line.split('\t', 1)
+            yield int(ordinal), row
+
+
+def merge_shards(data_dir, shard_count, target_size=256, store=False):
+    # combines the shards/ output of convert(..., shard_index=i, shard_count=shard_count) for every i
+    # into the train.txt, test.txt, test_common.txt, test_challenge.txt and indices.txt a single run writes
+    output_dirs = _output_dirs(data_dir, target_size)
+    parts = [_part_name(i, shard_count) for i in range(shard_count)]
+    for size, output_dir in output_dirs.items():
+        shard_dir = os.path.join(output_dir, 'shards')
+        missing = [x for x in parts if not os.path.exists(os.path.join(shard_dir, f'stats.{x}.json'))]
+        if missing:
+            raise FileNotFoundError(f'{output_dir}: missing shards {missing}')
+
+        for split in ('train', 'test'):
+            output = _SplitOutput(output_dir, split, size, store)
+            # every part is already in ordinal order, so a k-way merge restores the global order
+            rows = heapq.merge(*[_read_part(os.path.join(shard_dir, f'{split}.{x}.txt')) for x in parts])
+            try:
+                for _, row in rows:
+                    image_crop_name, coordinates = row.rstrip('\n').split(' ', 1)
+                    annotation = numpy.array(coordinates.split(), dtype=numpy.float64) if store else None
+                    output.write(image_crop_name, coordinates, annotation, None)
+            finally:
+                output.close()
+
+        stats = LandmarkStats()
+        for x in parts:
+            with open(os.path.join(shard_dir, f'stats.{x}.json'), 'r') as f:
+                stats.merge(LandmarkStats.from_state(json.load(f)))
+        _write_mean_face({size: output_dir}, stats)
+
+
+if __name__ == '__main__':
+    data_dir = '/mnt/data/Projects/Datasets/IR/'
+    convert(data_dir)
 
 
 # file_path = '/mnt/data/Projects/Datasets/IR/test.txt'
@@ -0,0 +1,54 @@
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def parse_pts(text):
+    # the points live between '{' and '}', whatever header or trailer lines a dataset adds;
+    # files without braces (dibox2, nir_face2) are plain coordinate lists
+    start = text.find('{')
+    end = text.rfind('}')
+    body = text[start + 1:end] if start != -1 and end > start else text
+    values = np.fromstring(body, dtype=np.float64, sep=' ')
+    if len(values) % 2 != 0:
+        raise ValueError('Unexpected number of landmark values. They should be in pairs.')
+    return values.reshape(-1, 2)
+
+
+def read_pts(pts_path):
+    with open(pts_path, 'r') as f:
+        return parse_pts(f.read())
+
+
+def format_pts(points):
+    points = np.asarray(points).reshape(-1, 2)
+    body = ('%s %s\n' * len(points)) % tuple(points.ravel().tolist())
+    return f"version: 1\nn_points:  {len(points)}\n{{\n{body}}}\n"
+
+
+def write_pts(pts_path, points):
+    text = format_pts(points)
+    with open(pts_path, 'w') as f:
+        f.write(text)
+
+
+def read_pts_batch(pts_paths, workers=8):
+    # file reads overlap in threads, parsing itself is vectorized
+    if workers > 1 and len(pts_paths) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            arrays = list(executor.map(read_pts, pts_paths))
+    else:
+        arrays = [read_pts(x) for x in pts_paths]
+    if not arrays:
+        return np.zeros((0, 0, 2))
+    counts = {len(x) for x in arrays}
+    if len(counts) != 1:
+        raise ValueError(f'Inconsistent number of points across files: {sorted(counts)}')
+    return np.stack(arrays)
+
+
+def load_pts_dir(directory, workers=8):
+    pts_paths = sorted(glob.glob(os.path.join(directory, '*.pts')))
+    return pts_paths, read_pts_batch(pts_paths, workers)
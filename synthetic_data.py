@@ -0,0 +1,123 @@
+import json
+import os
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+
+from landmark_schemes import index_ranges
+
+# Header and footer lines of the PTS files each dataset ships with; dibox2 and nir_face2 are bare
+# coordinate lists, prevent carries two extra lines after the closing brace
+PTS_LAYOUTS = {
+    'dv2': ('version: 1\nn_points: {n}\n{{\n', '}}\n'),
+    'dibox2': ('', ''),
+    'nir_face2': ('', ''),
+    'prevent': ('version: 1\nn_points: {n}\n{{\n', '}}\n\n\n'),
+    'zerone2': ('version: 1\nn_points:  {n}\n{{\n', '}}\n'),
+}
+
+
+def random_image(rng, width, height):
+    # upsampled noise compresses roughly like a photo, plain noise would not
+    small = rng.integers(0, 256, (max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC).astype(np.int16)
+    image += rng.normal(0, 4, image.shape).astype(np.int16)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def random_landmarks(rng, width, height, num_points=68):
+    # one face per image, its box 30-60% of the shorter side and fully inside the image
+    size = rng.uniform(0.3, 0.6) * min(width, height)
+    center = rng.uniform([size / 2, size / 2], [width - size / 2, height - size / 2])
+    return (center + rng.uniform(-0.5, 0.5, (num_points, 2)) * size).round(3)
+
+
+def _write_image(path, rng, image_size):
+    image = random_image(rng, *image_size)
+    if not cv2.imwrite(path, image):
+        raise IOError(f'cv2.imwrite failed for {path}')
+
+
+def write_pts_folder(folder, samples, rng, layout=('', ''), image_size=(640, 480), image_formats=('jpg', 'png'),
+                     num_points=68, prefix='', challenge_every=0):
+    # image/label pairs named <prefix>000000.<ext> / .pts; every challenge_every-th pair gets an
+    # ibug_ prefix, which preprocess.convert sends to test_challenge.txt
+    os.makedirs(folder, exist_ok=True)
+    header, footer = (x.format(n=num_points) for x in layout)
+    for i in range(samples):
+        name = f'{prefix}{i:06d}'
+        if challenge_every and i % challenge_every == 0:
+            name = 'ibug_' + name
+        _write_image(os.path.join(folder, f'{name}.{image_formats[i % len(image_formats)]}'), rng, image_size)
+        points = random_landmarks(rng, *image_size, num_points)
+        body = ''.join(f'{x} {y}\n' for x, y in points.tolist())
+        with open(os.path.join(folder, name + '.pts'), 'w') as f:
+            f.write(header + body + footer)
+    return samples
+
+
+def write_convert_dataset(data_dir, samples=100, datasets=None, splits=('train', 'test'), seed=0, **kwargs):
+    # the <dataset>/<split> tree preprocess.convert reads, samples pairs per folder
+    rng = np.random.default_rng(seed)
+    total = 0
+    for name in datasets or PTS_LAYOUTS:
+        for split in splits:
+            total += write_pts_folder(os.path.join(data_dir, name, split), samples, rng, PTS_LAYOUTS[name],
+                                      challenge_every=10 if split == 'test' else 0, **kwargs)
+    return total
+
+
+def write_keypoints_json(directory, samples=100, seed=0, image_size=(640, 480), num_points=68):
+    # vendor export read by json2pts: ObjectInfo.KeyPoints.Points is a flat x, y, x, y, ... list
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(samples):
+        _write_image(os.path.join(directory, f'{i:06d}.jpg'), rng, image_size)
+        points = random_landmarks(rng, *image_size, num_points)
+        data = {'ImageInfo': {'FileName': f'{i:06d}.jpg', 'Width': image_size[0], 'Height': image_size[1]},
+                'ObjectInfo': {'KeyPoints': {'Count': num_points, 'Points': points.ravel().tolist()}}}
+        with open(os.path.join(directory, f'{i:06d}.json'), 'w') as f:
+            json.dump(data, f)
+    return samples
+
+
+def write_face68_xml(directory, samples=100, seed=0, image_size=(640, 480), num_points=68):
+    # per-image XML with a face_68 element whose points attribute is 'x,y;x,y;...' (vaucher_data)
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(samples):
+        _write_image(os.path.join(directory, f'{i:06d}.jpg'), rng, image_size)
+        points = random_landmarks(rng, *image_size, num_points)
+        root = ET.Element('annotations')
+        image = ET.SubElement(root, 'image', name=f'{i:06d}.jpg', width=str(image_size[0]),
+                              height=str(image_size[1]))
+        ET.SubElement(image, 'face_68', points=';'.join(f'{x},{y}' for x, y in points.tolist()))
+        ET.ElementTree(root).write(os.path.join(directory, f'{i:06d}.xml'), encoding='utf8')
+    return samples
+
+
+def write_cvat_xml(xml_path, samples=100, seed=0, image_dir=None, image_size=(640, 480)):
+    # a single CVAT export in the zerone2 style: one skeleton per face region, its points in region
+    # order but labeled by name, so zerone has to relabel them from index_ranges
+    rng = np.random.default_rng(seed)
+    if image_dir is not None:
+        os.makedirs(image_dir, exist_ok=True)
+    num_points = max(end for _, end in index_ranges.values())
+    root = ET.Element('annotations')
+    ET.SubElement(root, 'version').text = '1.1'
+    for i in range(samples):
+        if image_dir is not None:
+            _write_image(os.path.join(image_dir, f'{i:06d}.jpg'), rng, image_size)
+        points = random_landmarks(rng, *image_size, num_points)
+        image = ET.SubElement(root, 'image', id=str(i), name=f'{i:06d}.jpg', width=str(image_size[0]),
+                              height=str(image_size[1]))
+        for region, (start, end) in index_ranges.items():
+            skeleton = ET.SubElement(image, 'skeleton', label=region, source='manual', occluded='0')
+            for k in range(start, end + 1):
+                x, y = points[k - 1].tolist()
+                ET.SubElement(skeleton, 'points', label=f'{region}_{k - start}', source='manual', outside='0',
+                              occluded='0', points=f'{x},{y}')
+    os.makedirs(os.path.dirname(os.path.abspath(xml_path)), exist_ok=True)
+    ET.ElementTree(root).write(xml_path, encoding='utf8')
+    return samples
@@ -0,0 +1,47 @@
+import json
+import os
+import shutil
+
+from landmark_store import load_store
+from preprocess import DATASETS, LandmarkStats, convert
+from synthetic_data import write_convert_dataset
+
+
+def test_stats_without_rows():
+    stats = LandmarkStats()
+    assert stats.mean is None
+    assert stats.to_dict()['count'] == 0
+
+
+def test_convert_empty_train_split(tmp_path):
+    data_dir = str(tmp_path)
+    write_convert_dataset(data_dir, samples=3, image_size=(160, 120))
+    for name in DATASETS:
+        shutil.rmtree(os.path.join(data_dir, name, 'train'))
+        os.makedirs(os.path.join(data_dir, name, 'train'))
+
+    convert(data_dir, target_size=32)
+
+    with open(os.path.join(data_dir, 'train.txt')) as f:
+        assert f.read() == ''
+    with open(os.path.join(data_dir, 'test.txt')) as f:
+        assert len(f.read().splitlines()) == 15
+    assert not os.path.exists(os.path.join(data_dir, 'indices.txt'))
+    with open(os.path.join(data_dir, 'landmark_stats.json')) as f:
+        assert json.load(f)['count'] == 0
+
+
+def test_convert_store_skips_other_point_counts(tmp_path):
+    data_dir = str(tmp_path)
+    write_convert_dataset(data_dir, samples=3, image_size=(160, 120))
+    label_path = os.path.join(data_dir, 'dv2', 'train', '000002.pts')
+    with open(label_path, 'w') as f:
+        f.write(''.join(f'{40 + i} {30 + i}\n' for i in range(5)))
+
+    convert(data_dir, target_size=32, store=True)
+
+    image_paths, landmarks = load_store(os.path.join(data_dir, 'train'))
+    with open(os.path.join(data_dir, 'train.txt')) as f:
+        rows = [line.split()[0] for line in f]
+    assert rows == image_paths
+    assert landmarks.shape == (14, 68, 2)
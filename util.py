@@ -1,35 +1,96 @@
+import hashlib
+import math
 import os
-import cv2
-import random
 import shutil
-from PIL import Image
+import threading
+import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
+from instrument import get_profiler
 
-def get_sub_imgs(path, target_path):
-    extensions = ['.xml', '.jpeg', '.png', '.gif', '.bmp', '.tiff']
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# cv2, PIL and numpy (through pts) are imported by the functions that need them, so the file and
+# name helpers start without loading them
 
-    os.makedirs(target_path, exist_ok=True)
-    for dirs, _, files in os.walk(path):
-        if dirs != path:
-            for filename in files:
-                if any(filename.lower().endswith(ext) for ext in extensions):
-                    source = os.path.join(dirs, filename)
 
-                    target = os.path.join(target_path, filename)
-                    base, ext = os.path.splitext(target)
-                    counter = 1
-                    while os.path.exists(target):
-                        target = f"{base}_{counter}{ext}"
-                        counter += 1
+def _walk_files(path, skip_dir=None):
+    # os.walk order (files of a directory, then its subdirectories), but from a single
+    # os.scandir per directory and without following the target directory
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            else:
+                yield path, entry.name
+    for subdir in subdirs:
+        if skip_dir is None or os.path.abspath(subdir) != skip_dir:
+            yield from _walk_files(subdir, skip_dir)
 
-                    shutil.move(source, target)
 
+def plan_sub_imgs(path, target_path):
+    extensions = ['.xml', '.jpeg', '.png', '.gif', '.bmp', '.tiff']
 
-def verify_name_pairs(image_path, label_path):
-    # List directory contents
-    images = os.listdir(image_path)
-    labels = os.listdir(label_path)
+    # names already in the target plus everything planned so far, so collisions are
+    # resolved in memory instead of with an os.path.exists probe per candidate
+    taken = set()
+    if os.path.isdir(target_path):
+        with os.scandir(target_path) as entries:
+            taken = {entry.name for entry in entries}
+    next_counter = {}
+
+    moves = []
+    for dirs, filename in _walk_files(path, os.path.abspath(target_path)):
+        if dirs == path or not filename.lower().endswith(tuple(extensions)):
+            continue
+        target_name = filename
+        if target_name in taken:
+            base, ext = os.path.splitext(filename)
+            counter = next_counter.get(filename, 1)
+            while f"{base}_{counter}{ext}" in taken:
+                counter += 1
+            next_counter[filename] = counter + 1
+            target_name = f"{base}_{counter}{ext}"
+        taken.add(target_name)
+        moves.append((os.path.join(dirs, filename), os.path.join(target_path, target_name)))
+    return moves
+
+
+def execute_moves(moves, workers=1):
+    # targets from plan_sub_imgs are unique, so the moves can run in any order
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda move: shutil.move(*move), moves))
+    else:
+        for source, target in moves:
+            shutil.move(source, target)
+
+
+def get_sub_imgs(path, target_path, dry_run=False, workers=1):
+    profiler = get_profiler()
+    with profiler.stage('list'):
+        moves = plan_sub_imgs(path, target_path)
+    if not dry_run:
+        os.makedirs(target_path, exist_ok=True)
+        with profiler.stage('move'):
+            execute_moves(moves, workers)
+        profiler.count('files', len(moves))
+    return moves
+
+
+def verify_name_pairs(image_path, label_path, catalog=None):
+    # List directory contents, or take them from a catalog.Catalog when it covers both folders
+    if catalog is not None and catalog.has_folder(image_path) and catalog.has_folder(label_path):
+        images = [x.decode() for x in catalog.columns['image'][catalog.folder_rows(image_path)] if x]
+        labels = [x.decode() for x in catalog.columns['label'][catalog.folder_rows(label_path)] if x]
+    else:
+        images = os.listdir(image_path)
+        labels = os.listdir(label_path)
 
     # Extract filenames without extensions and filter based on desired extensions
     image_names = [os.path.splitext(im)[0] for im in images if im.endswith(('.png'))]
@@ -44,112 +105,279 @@ def verify_name_pairs(image_path, label_path):
         print("error comes from images folder:", diff_img_label)
         print("error comes from label folder:", diff_label_img)
         print('Please check folders.')
-    else:
-        print('OK...')
-
-
-def visualize_landmarks(image_name, pts_name, output_name=None):
-    with open(pts_name, 'r') as file:
-        content = file.readlines()
+        return False
+    print('OK...')
+    return True
 
-    start_idx = next(i for i, line in enumerate(content) if "{" in line) + 1
-    end_idx = next(i for i, line in enumerate(content) if "}" in line)
-    landmarks_data = content[3:-3]
 
-    landmarks = [tuple(map(float, line.split())) for line in landmarks_data]
+def draw_landmarks(img, landmarks, radius=2, numbers=True, color=(0, 0, 255)):
+    import cv2
+    for idx, (x, y) in enumerate(landmarks):
+        if not (math.isfinite(x) and math.isfinite(y)):
+            continue
+        cv2.circle(img, (int(x), int(y)), radius, color, -1)
+        if numbers:
+            cv2.putText(img, str(idx+1), (int(x) + 2, int(y)), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 255, 255), 1)
+    return img
 
-    img = cv2.imread(image_name)
 
-    for idx, (x, y) in enumerate(landmarks):
-        cv2.circle(img, (int(x), int(y)), 2, (0, 0, 255), -1)  # Drawing a red circle for each point
-        cv2.putText(img, str(idx+1), (int(x) + 2, int(y)), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (255, 255, 255), 1)
+def visualize_landmarks(image_name, pts_name, output_name=None, show=True):
+    # show=False for servers without a display; contact_sheet.py renders whole batches
+    import cv2
+    from pts import read_pts
+    landmarks = read_pts(pts_name)
 
-    cv2.imshow("Face Landmarks", img)
+    img = draw_landmarks(cv2.imread(image_name), landmarks)
 
     if output_name:
         cv2.imwrite(output_name, img)
 
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
-
-
-
-def split_dataset(main_folder, train_folder, test_folder, test_ratio=0.2):
+    if show:
+        cv2.imshow("Face Landmarks", img)
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+    return img
+
+
+FICLONE = 0x40049409
+
+
+def _reflink(source, destination):
+    # copy-on-write clone (btrfs, xfs, ...); raises OSError where unsupported
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def place_file(source, destination, mode='copy'):
+    # mode: 'move', 'copy' or 'link' (hardlink, else reflink, else a regular copy)
+    if mode == 'move':
+        shutil.move(source, destination)
+        return
+    if mode == 'link':
+        if os.path.lexists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+        if fcntl is not None:
+            try:
+                _reflink(source, destination)
+                return
+            except OSError:
+                if os.path.exists(destination):
+                    os.remove(destination)
+    shutil.copy(source, destination)
+
+
+def split_key(name, seed=0):
+    # position of a sample in the seeded order, independent of listing order and of random's state
+    stem = os.path.splitext(name)[0]
+    return hashlib.sha1(f'{seed}:{stem}'.encode()).hexdigest()
+
+
+def split_dataset(main_folder, train_folder, test_folder, test_ratio=0.2, seed=0, mode='move', manifest_path=None,
+                  catalog=None):
+    # mode: 'move' / 'copy' / 'link' place files into train_folder and test_folder, 'manifest' only
+    # writes <main_folder>/split.txt, which preprocess.convert reads instead of train/test folders.
+    # With a catalog.Catalog the files and their labels come from it instead of listing the folder
     image_extensions = ['.png']
     label_extensions = ['.pts']
-    # Ensure the train and test folders exist
-    os.makedirs(train_folder, exist_ok=True)
-    os.makedirs(test_folder, exist_ok=True)
 
-    # Get all image files from the main folder
-    image_files = [f for f in os.listdir(main_folder) if os.path.isfile(os.path.join(main_folder, f)) and any(
-        f.lower().endswith(ext) for ext in image_extensions)]
+    # Get all image files from the main folder, listing it when the catalog does not cover it
+    if catalog is not None and not catalog.has_folder(main_folder):
+        catalog = None
+    if catalog is not None:
+        rows = catalog.folder_rows(main_folder)
+        catalog_labels = {image.decode(): label.decode() or None for image, label in
+                          zip(catalog.columns['image'][rows], catalog.columns['label'][rows]) if image}
+        image_files = [f for f in catalog_labels if any(f.lower().endswith(ext) for ext in image_extensions)]
+    else:
+        image_files = [f for f in os.listdir(main_folder) if os.path.isfile(os.path.join(main_folder, f)) and any(
+            f.lower().endswith(ext) for ext in image_extensions)]
 
-    # Shuffle and split the files
-    random.shuffle(image_files)
+    # Order deterministically by the seeded hash and split
+    image_files.sort(key=lambda f: split_key(f, seed))
     split_index = int(len(image_files) * (1 - test_ratio))
     train_files = image_files[:split_index]
     test_files = image_files[split_index:]
 
-    # Move files function (nested within the main function)
-    def move_files(files, source_folder, destination_folder):
+    def label_of(filename):
+        if catalog is not None:
+            return catalog_labels.get(filename)
+        base_name, _ = os.path.splitext(filename)
+        for ext in label_extensions:
+            label_file = f"{base_name}{ext}"
+            if os.path.exists(os.path.join(main_folder, label_file)):
+                return label_file
+        return None
+
+    if mode == 'manifest':
+        if manifest_path is None:
+            manifest_path = os.path.join(main_folder, 'split.txt')
+        with open(manifest_path, 'w') as f:
+            for split, files in (('train', train_files), ('test', test_files)):
+                for filename in sorted(files):
+                    label_file = label_of(filename)
+                    if label_file is not None:
+                        f.write(f"{split}\t{filename}\t{label_file}\n")
+        return manifest_path
+
+    # Ensure the train and test folders exist
+    os.makedirs(train_folder, exist_ok=True)
+    os.makedirs(test_folder, exist_ok=True)
+
+    # Place files function (nested within the main function)
+    def place_files(files, source_folder, destination_folder):
         for filename in files:
-            # Move the image file
-            shutil.move(os.path.join(source_folder, filename), os.path.join(destination_folder, filename))
+            # Place the image file
+            place_file(os.path.join(source_folder, filename), os.path.join(destination_folder, filename), mode)
 
-            # Move the corresponding label file
-            base_name, _ = os.path.splitext(filename)
-            for ext in label_extensions:
-                label_file = f"{base_name}{ext}"
-                label_path = os.path.join(source_folder, label_file)
-                if os.path.exists(label_path):
-                    shutil.move(label_path, os.path.join(destination_folder, label_file))
+            # Place the corresponding label file
+            label_file = label_of(filename)
+            if label_file is not None:
+                place_file(os.path.join(source_folder, label_file), os.path.join(destination_folder, label_file),
+                           mode)
 
-    # Call the move files function for train and test data
-    move_files(train_files, main_folder, train_folder)
-    move_files(test_files, main_folder, test_folder)
+    # Call the place files function for train and test data
+    place_files(train_files, main_folder, train_folder)
+    place_files(test_files, main_folder, test_folder)
 
 
-def collect_files(src1, src2, destination):
+def collect_files(src1, src2, destination, mode='copy'):
+    # mode='link' hardlinks (or reflinks) instead of copying, see place_file
     os.makedirs(destination, exist_ok=True)
 
     def copy_from_source(src):
         for filename in os.listdir(src):
             file_path = os.path.join(src, filename)
             if os.path.isfile(file_path):
-                shutil.copy(file_path, os.path.join(destination, filename))
+                place_file(file_path, os.path.join(destination, filename), mode)
 
     copy_from_source(src1)
     copy_from_source(src2)
 
 
-def convert_PNG(folder_path):
+def _read_convert_journal(journal_path):
+    # "<source>\t<size>\t<mtime_ns>" of every source whose output was about to be renamed into place,
+    # sources relative to the converted folder so any spelling of its path finds them
+    done = {}
+    if os.path.exists(journal_path):
+        with open(journal_path, 'r') as f:
+            for line in f:
+                row = line.rstrip('\n').split('\t')
+                if len(row) == 3:
+                    done[row[0]] = (int(row[1]), int(row[2]))
+    return done
+
+
+def _convert_image(file_path, key, image_format, save_options, done, record):
+    from PIL import Image
+    new_file_path = os.path.splitext(file_path)[0] + '.' + image_format.lower()
+    st = os.stat(file_path)
+    identity = (st.st_size, st.st_mtime_ns)
+    if os.path.exists(new_file_path):
+        if done.get(key) == identity:
+            # journaled before the rename, so the output is ours and only the removal was cut short
+            os.remove(file_path)
+            return 'resumed', 0, 0
+        # an unrelated file of the same name, the source is kept
+        return 'conflict', file_path, f'{new_file_path} already exists'
+    profiler = get_profiler()
+    bytes_in = st.st_size
+    tmp_path = new_file_path + '.tmp'
+    with Image.open(file_path) as img:
+        with profiler.stage('decode'):
+            img.load()
+        with profiler.stage('encode'):
+            img.save(tmp_path, image_format, **save_options)
+    bytes_out = os.path.getsize(tmp_path)
+    profiler.count('files')
+    profiler.count('bytes_read', bytes_in)
+    profiler.count('bytes_written', bytes_out)
+    record(key, identity)
+    os.replace(tmp_path, new_file_path)
+    os.remove(file_path)
+    return 'converted', bytes_in, bytes_out
+
+
+def convert_PNG(folder_path, workers=1, image_format='PNG', compress_level=6):
+    # image_format: 'PNG' (compress_level 0-9), lossless 'WEBP' or uncompressed 'BMP'.
+    # An existing output is only trusted when .convert_journal says this function wrote it; any
+    # other name clash is reported as a conflict and the source is kept
     supported_formats = ("jpeg", "jpg", 'JPG', 'JPEG')
-
-    converted_and_removed_count = 0
-    i = 0
-    for root, _, files in os.walk(folder_path):
-        for file in files:
-            i += 1
-            if file.lower().endswith(supported_formats):
-                try:
-                    file_path = os.path.join(root, file)
-
-                    img = Image.open(file_path)
-
-                    new_file_path = os.path.splitext(file_path)[0] + ".png"
-
-                    img.save(new_file_path, "PNG")
-
-                    os.remove(file_path)
-
-                    converted_and_removed_count += 1
-
-                    print(f"Converted and removed: {file_path} -> {new_file_path}")
-                except Exception as e:
-                    print(f"Failed to convert and remove {file}: {e}")
-            print('i = ', i)
-    print(f"Total images converted and removed: {converted_and_removed_count}")
+    save_options = {'PNG': {'compress_level': compress_level}, 'WEBP': {'lossless': True}}.get(image_format, {})
+
+    file_paths = []
+    with get_profiler().stage('list'):
+        for root, _, files in os.walk(folder_path):
+            for file in files:
+                if file.lower().endswith(supported_formats):
+                    file_paths.append(os.path.join(root, file))
+
+    # a.jpg and a.jpeg would both become a.png, such sources are all kept and reported
+    by_output = {}
+    for file_path in file_paths:
+        by_output.setdefault(os.path.splitext(file_path)[0], []).append(file_path)
+    results = []
+    for stem, sources in by_output.items():
+        if len(sources) > 1:
+            for file_path in sources:
+                results.append(('conflict', file_path, f'{len(sources)} sources for {stem}.{image_format.lower()}'))
+    todo = [sources[0] for sources in by_output.values() if len(sources) == 1]
+
+    journal_path = os.path.join(folder_path, '.convert_journal')
+    done = _read_convert_journal(journal_path)
+    journal = open(journal_path, 'a')
+    journal_lock = threading.Lock()
+
+    def record(key, identity):
+        with journal_lock:
+            journal.write(f'{key}\t{identity[0]}\t{identity[1]}\n')
+            journal.flush()
+
+    def convert_one(file_path):
+        try:
+            return _convert_image(file_path, os.path.relpath(file_path, folder_path), image_format, save_options,
+                                  done, record)
+        except Exception as e:
+            get_profiler().count('failures')
+            return 'failed', file_path, f'{type(e).__name__}: {e}'
+
+    start = time.perf_counter()
+    # PIL releases the GIL while encoding and decoding, so threads are enough here
+    try:
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results += executor.map(convert_one, todo)
+        else:
+            results += [convert_one(x) for x in todo]
+    finally:
+        journal.close()
+    # once every source is converted and removed the journal has nothing left to say; a failure
+    # may have come after its journal entry (e.g. the removal of the source), so then it is kept
+    if not any(status == 'failed' for status, _, _ in results):
+        os.remove(journal_path)
+
+    stats = Counter(status for status, _, _ in results)
+    failures = [(path, error) for status, path, error in results if status == 'failed']
+    conflicts = [(path, error) for status, path, error in results if status == 'conflict']
+    bytes_in = sum(x[1] for x in results if x[0] == 'converted')
+    bytes_out = sum(x[2] for x in results if x[0] == 'converted')
+    elapsed = time.perf_counter() - start
+    summary = {'found': len(file_paths), 'converted': stats['converted'], 'resumed': stats['resumed'],
+               'conflicts': conflicts, 'failed': failures, 'bytes_in': bytes_in, 'bytes_out': bytes_out,
+               'elapsed': elapsed}
+
+    print(f"Total images converted and removed: {summary['converted']} "
+          f"({summary['resumed']} resumed, {len(conflicts)} kept for a name conflict, {len(failures)} failed) "
+          f"in {elapsed:.1f}s, {bytes_in / 2 ** 20:.1f} MB -> {bytes_out / 2 ** 20:.1f} MB")
+    for path, error in conflicts[:10]:
+        print(f"Kept {path}: {error}")
+    for path, error in failures[:10]:
+        print(f"Failed to convert and remove {path}: {error}")
+    return summary
 
 
 def move_different_files(images_folder, labels_folder, different_folder):
@@ -1,49 +1,16 @@
 import os
-import cv2
 import glob
-import shutil
-import numpy as np
-import xml.etree.ElementTree as ET
 
-def batch_convert_xml_to_pts_robust(input_dir, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
-    
+from label_convert import convert_labels, parse_face68_xml
+
+def batch_convert_xml_to_pts_robust(input_dir, output_dir, workers=1, report_path=None):
     xml_files = glob.glob(os.path.join(input_dir, '*.xml'))
     
-    for xml_file in xml_files:
-        try:
-            pts_filename = os.path.basename(xml_file).replace('.xml', '.pts')
-            pts_filepath = os.path.join(output_dir, pts_filename)
-            
-            tree = ET.parse(xml_file)
-            root = tree.getroot()
-            
-            face_68_elem = root.find('.//face_68')
-            if face_68_elem is not None and 'points' in face_68_elem.attrib:
-                points_str = face_68_elem.attrib['points']
-                points_list = points_str.split(';')
-                points = [[float(coord) for coord in point.split(',')[:2]] for point in points_list if len(point.split(',')) >= 2]
-                if len(points) != 68:
-                    print(f"Warning: Expected 68 points, but found {len(points)} in {os.path.basename(xml_file)}")
-            else:
-                print(f"No facial landmark points found in {os.path.basename(xml_file)}")
-                continue
-            
-            points = np.array(points)
-            
-            with open(pts_filepath, 'w') as f:
-                f.write("version: 1\n")
-                f.write(f"n_points:  {len(points)}\n")
-                f.write("{\n")
-                for point in points:
-                    f.write(f"{point[0]} {point[1]}\n")
-                f.write("}\n")
-            
-            print(f"Successfully converted: {os.path.basename(xml_file)} -> {pts_filename}")
-        except Exception as e:
-            print(f"Error processing {os.path.basename(xml_file)}: {str(e)}")
+    report = convert_labels(xml_files, output_dir, parse_face68_xml, workers=workers, expected_points=68,
+                            report_path=report_path)
     
     print("Batch conversion completed.")
+    return report
 
 
 def count_facial_landmarks_pts(pts_file_path):
@@ -62,7 +29,20 @@ def count_facial_landmarks_pts(pts_file_path):
         print(f"Error processing {os.path.basename(pts_file_path)}: {str(e)}")
         return None
 
-def check_pts_files(directory):
+def check_pts_files(directory, catalog=None):
+    if catalog is not None and catalog.has_folder(directory):
+        # the catalog holds the number of points parsed from each file rather than its n_points
+        # header, -1 marks a file that could not be read
+        rows = catalog.folder_rows(directory)
+        for label, n_points in zip(catalog.columns['label'][rows], catalog.columns['points'][rows].tolist()):
+            if not label:
+                continue
+            if n_points < 0:
+                print(f"Error processing {label.decode()}: unreadable")
+            elif n_points != 68:
+                print(f"{label.decode()}: {n_points} points")
+        return
+
     pts_files = glob.glob(os.path.join(directory, '*.pts'))
     
     for pts_file in pts_files:
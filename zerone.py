@@ -1,28 +1,14 @@
 # Importing required libraries
 import os
-import cv2 
 import numpy as np
 import glob
 import xml.etree.ElementTree as ET
 
+from instrument import get_profiler
+from label_convert import convert_labels, indexed_points, parse_cvat_points
+from landmark_schemes import index_ranges, region_index
+from pts import write_pts
 
-file_path = '/mnt/data/Projects/Datasets/zerone2/face_annotations.xml'
-tree = ET.parse(file_path)
-root = tree.getroot()
-
-output_dir = '/mnt/data/Projects/Datasets/zerone2/label'
-os.makedirs(output_dir, exist_ok=True)
-
-index_ranges = {
-    'jaw': (1, 17),
-    'right_eyebrow': (18, 22),
-    'left_eyebrow': (23, 27),
-    'nose': (28, 36),
-    'right_eye': (37, 42),
-    'left_eye': (43, 48),
-    'mouth': (49, 60),
-    'inner_mouth': (61, 68)
-}
 
 def xml_to_pts(xml_filepath, pts_filepath):
     # Parse the XML file
@@ -46,32 +32,13 @@ def xml_to_pts(xml_filepath, pts_filepath):
     points = np.array(points)
     
     # Write to PTS file
-    with open(pts_filepath, 'w') as f:
-        f.write("version: 1\n")
-        f.write(f"n_points:  {len(points)}\n")
-        f.write("{\n")
-        for point in points:
-            f.write(f"{point[0]} {point[1]}\n")
-        f.write("}\n")
+    write_pts(pts_filepath, points)
     
     print(f"Successfully converted: {os.path.basename(xml_filepath)} -> {os.path.basename(pts_filepath)}")
 
 
 
-def save_individual_xml_corrected(image_elem, output_dir, index_ranges):
-    # Creating a new XML tree
-    new_tree = ET.ElementTree(ET.Element('annotations'))
-    new_root = new_tree.getroot()
-
-    # Adding the image element to the new XML tree
-    new_root.append(image_elem)
-
-    # Getting the image ID to create a filename
-    image_id = image_elem.get('name').split('.')[0]
-    filename = f"{image_id}.xml"
-    filepath = os.path.join(output_dir, filename)
-
-    # Correcting the indexing of facial landmarks
+def correct_landmark_indexes(image_elem, index_ranges):
     for skeleton_elem in image_elem.findall('.//skeleton'):
         label = skeleton_elem.get('label')
         if label in index_ranges:
@@ -79,14 +46,28 @@ def save_individual_xml_corrected(image_elem, output_dir, index_ranges):
             for i, point_elem in enumerate(skeleton_elem.findall('.//points'), start=index_range[0]):
                 point_elem.set('label', str(i))
 
-    # Saving the new XML tree to a file
-    new_tree.write(filepath, encoding='utf8')
-
-
-for image_elem in root.findall('.//image'):
-    save_individual_xml_corrected(image_elem, output_dir, index_ranges)
 
-output_dir
+def skeleton_points(image_elem, index_ranges):
+    # what correct_landmark_indexes + indexed_points give, without rewriting the XML: every skeleton's
+    # points are placed by region_index in one array operation
+    regions = []
+    coords = []
+    for skeleton_elem in image_elem.findall('.//skeleton'):
+        point_elems = skeleton_elem.findall('.//points')
+        regions.append((skeleton_elem.get('label'), len(point_elems)))
+        for point_elem in point_elems:
+            xy = point_elem.get('points', '').split(',')
+            coords.append(xy if len(xy) == 2 else ('nan', 'nan'))
+    if not coords:
+        return None
+    target = region_index(regions, index_ranges)
+    coords = np.array(coords, dtype=np.float64)
+    keep = (target >= 0) & ~np.isnan(coords[:, 0])
+    if not keep.any():
+        return None
+    # of points sharing a target index the last one wins, as with the relabeled XML
+    _, last = np.unique(target[keep][::-1], return_index=True)
+    return coords[keep][::-1][last]
 
 
 def save_individual_xml_corrected(image_elem, output_dir, index_ranges):
@@ -103,12 +84,7 @@ def save_individual_xml_corrected(image_elem, output_dir, index_ranges):
     filepath = os.path.join(output_dir, filename)
 
     # Correcting the indexing of facial landmarks
-    for skeleton_elem in image_elem.findall('.//skeleton'):
-        label = skeleton_elem.get('label')
-        if label in index_ranges:
-            index_range = index_ranges[label]
-            for i, point_elem in enumerate(skeleton_elem.findall('.//points'), start=index_range[0]):
-                point_elem.set('label', str(i))
+    correct_landmark_indexes(image_elem, index_ranges)
 
     # Saving the new XML tree to a file
     new_tree.write(filepath, encoding='utf8')
@@ -119,51 +95,78 @@ def xml_to_pts_based_on_indexes(xml_filepath, pts_filepath):
     tree = ET.parse(xml_filepath)
     root = tree.getroot()
     
-    # Extract facial landmark points with their indexes
-    points_dict = {}
-    for point_elem in root.findall('.//points'):
-        if 'points' in point_elem.attrib and 'label' in point_elem.attrib:
-            index = int(point_elem.attrib['label'])
-            coords = point_elem.attrib['points'].split(',')
-            if len(coords) == 2:
-                points_dict[index] = [float(coords[0]), float(coords[1])]
+    # Extract facial landmark points sorted by their indexes
+    points = indexed_points(root)
     
     # Check if points were found
-    if not points_dict:
+    if points is None:
         print(f"No points found in {os.path.basename(xml_filepath)}")
         return
     
-    # Sort the points based on their indexes
-    sorted_points = [points_dict[i] for i in sorted(points_dict.keys())]
-    
-    # Convert points to numpy array for easier handling
-    points = np.array(sorted_points)
-    
     # Write to PTS file
-    with open(pts_filepath, 'w') as f:
-        f.write("version: 1\n")
-        f.write(f"n_points:  {len(points)}\n")
-        f.write("{\n")
-        for point in points:
-            f.write(f"{point[0]} {point[1]}\n")
-        f.write("}\n")
+    write_pts(pts_filepath, points)
     
     print(f"Successfully converted: {os.path.basename(xml_filepath)} -> {os.path.basename(pts_filepath)}")
 
 
-def convert_xml_to_pts_based_on_indexes(input_dir, output_dir):
+def convert_xml_to_pts_based_on_indexes(input_dir, output_dir, workers=1, report_path=None):
     # Find all XML files in the specified directory
     xml_files = glob.glob(os.path.join(input_dir, '*.xml'))
     
-    # Ensure the output directory exists
+    # Convert every XML file to PTS format
+    return convert_labels(xml_files, output_dir, parse_cvat_points, workers=workers, report_path=report_path)
+
+
+def iter_images(xml_filepath):
+    # Yields every <image> of a CVAT export as soon as it is parsed
+    context = ET.iterparse(xml_filepath, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event == 'end' and elem.tag == 'image':
+            yield elem
+            # Dropping finished images keeps memory constant regardless of the file size
+            root.clear()
+
+
+def stream_xml_to_pts(xml_filepath, pts_dir, index_ranges, xml_dir=None):
+    # Single pass over the whole CVAT export: every <image> is relabeled and written as PTS
+    # (and optionally as an individual XML) as soon as it is parsed, then freed
+    os.makedirs(pts_dir, exist_ok=True)
+    if xml_dir is not None:
+        os.makedirs(xml_dir, exist_ok=True)
+
+    profiler = get_profiler()
+    profiler.count('bytes_read', os.path.getsize(xml_filepath))
+    converted = 0
+    missing = 0
+    for elem in iter_images(xml_filepath):
+        profiler.count('files')
+        with profiler.stage('relabel'):
+            if xml_dir is not None:
+                save_individual_xml_corrected(elem, xml_dir, index_ranges)
+                points = indexed_points(elem)
+            else:
+                points = skeleton_points(elem, index_ranges)
+
+        image_id = elem.get('name').split('.')[0]
+        if points is None:
+            print(f"No points found in {image_id}")
+            profiler.count('failures')
+            missing += 1
+        else:
+            with profiler.stage('write'):
+                write_pts(os.path.join(pts_dir, f"{image_id}.pts"), points)
+            converted += 1
+
+    print(f"Converted {converted} images, {missing} without points")
+    return converted
+
+
+if __name__ == '__main__':
+    file_path = '/mnt/data/Projects/Datasets/zerone2/face_annotations.xml'
+
+    output_dir = '/mnt/data/Projects/Datasets/zerone2/label'
     os.makedirs(output_dir, exist_ok=True)
-    
-    # Loop through each XML file
-    for xml_file in xml_files:
-        # Creating the PTS filename based on the XML filename
-        pts_filename = os.path.basename(xml_file).replace('.xml', '.pts')
-        pts_filepath = os.path.join(output_dir, pts_filename)
-        
-        # Convert the XML file to PTS format
-        xml_to_pts_based_on_indexes(xml_file, pts_filepath)
 
+    for image_elem in iter_images(file_path):
+        save_individual_xml_corrected(image_elem, output_dir, index_ranges)